@@ -1,151 +1,1008 @@
-import sys
 import os
 import time
+import signal
+import argparse
+import zlib
 import socket
-import select
+import asyncio
+import ipaddress
+from contextlib import nullcontext
+from urllib.parse import urlsplit, parse_qs
 
+from proxycache import Cache
+from proxypool import OriginPool
+from proxymetrics import Metrics, Profiler, PROFILE_RATE
 
-def init_server_sock():
+# bytes read from a web server at a time
+BUFFER_SIZE = 64 * 1024
+# zlib wbits of the compressed formats of Content-Encoding, and the level
+# pages are compressed again at after the banner is inserted
+ENCODINGS = {b'gzip': 31, b'x-gzip': 31, b'deflate': 15}
+COMPRESS_LEVEL = 6
+
+# state of the open client connections, keyed by the connection's
+# StreamWriter; entries are removed when the connection closes
+clients = {}
+# responses being fetched, keyed by cache key
+fetches = {}
+# port of the web servers, set by --origin-port
+origin_port = 80
+# whether the URL of every request is printed, set by --verbose
+verbose = False
+# counters and latencies of this process, and the profiler of its hot paths,
+# served on /ADMIN_HOST/metrics and /ADMIN_HOST/profile to local clients
+metrics = Metrics()
+profiler = Profiler()
+ADMIN_HOST = '__proxy'
+
+
+def init_server_sock(host='localhost', port=8888, reuse_port=False):
     """
-    initialize a non blocking server socket
+    initialize a non blocking server socket; with reuse_port, every worker
+    process binds its own socket to the port and the kernel spreads the
+    connections between them
     """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.setblocking(0)
-    server.bind(('localhost', 8888))
-    server.listen(5)
+    server.bind((host, port))
+    server.listen(socket.SOMAXCONN)
     return server
 
 
-def extra_info_from_data(data):
+def parse_request(head):
+    """
+    split the head of a client request into its HTTP version, the host and
+    path of the page asked for, its header lines and a dict of its headers
+    with lower case names. The target is /host/path, as typed after the
+    proxy's address, or an absolute http:// URL. Raise ValueError if the
+    request is malformed
+    """
+    lines = [line for line in head.split(b'\r\n') if line]
+    if not lines:
+        raise ValueError('Empty request')
+    method, target, version = lines[0].split(b' ')
+    if target.lower().startswith(b'http://'):
+        target = target[6:]
+    host, _, path = target[1:].partition(b'/')
+    if not host or not version.startswith(b'HTTP/'):
+        raise ValueError('Bad request line: {!r}'.format(lines[0]))
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise ValueError('Bad header: {!r}'.format(line))
+        headers[name.strip().lower()] = value.strip()
+    return version, host.decode('latin-1'), '/' + path.decode('latin-1'), lines[1:], headers
+
+
+# client headers not forwarded to the web server: they concern the
+# connection to the proxy, are set by the proxy, or would let the web
+# server answer 304 or 206 to a request the cache needs the whole page for
+DROPPED_HEADERS = {b'host', b'connection', b'proxy-connection', b'keep-alive', b'accept-encoding',
+                   b'if-none-match', b'if-modified-since', b'range', b'if-range',
+                   b'content-length', b'transfer-encoding'}
+
+
+def accepted_encoding(headers):
+    """
+    the content coding asked from the web server for a client: gzip or
+    else deflate if the client's Accept-Encoding allows it, else identity
+    """
+    accepted = {}
+    for item in headers.get(b'accept-encoding', b'').lower().split(b','):
+        coding, _, params = item.partition(b';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith(b'q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    for coding in (b'gzip', b'deflate'):
+        if accepted.get(coding, accepted.get(b'*', 0.0)) > 0:
+            return coding.decode()
+    return 'identity'
+
+
+def make_request(host_name, path, header_lines, encoding='identity'):
+    """
+    the request sent to the web server for path on host_name, keeping the
+    client's headers but asking for the given content coding over a
+    keep-alive connection
+    """
+    lines = [b'GET ' + bytes(path, 'latin-1') + b' HTTP/1.1', b'Host: ' + bytes(host_name, 'latin-1')]
+    for line in header_lines:
+        if line.split(b':', 1)[0].strip().lower() not in DROPPED_HEADERS:
+            lines.append(line)
+    lines += [b'Accept-Encoding: ' + bytes(encoding, 'latin-1'), b'Connection: keep-alive']
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def wants_keep_alive(version, headers):
+    """
+    whether the client keeps its connection open after a response
+    """
+    connection = headers.get(b'connection', b'').lower()
+    if version == b'HTTP/1.0':
+        return b'keep-alive' in connection
+    return b'close' not in connection
+
+
+def cache_key(host_name, request_data, banner, encoding='identity'):
+    """
+    the cache key of a page: its URL, with the host in lower case and
+    without the default port, the path without the fragment, whether the
+    page is stored with the banner, and the content coding asked for it
+    """
+    host_name = host_name.lower()
+    if host_name.endswith(':80'):
+        host_name = host_name[:-3]
+    path = request_data.split('#')[0] or '/'
+    return '{} {} http://{}{}'.format('banner' if banner else 'plain', encoding, host_name, path)
+
+
+def get_validators(headers):
     """
-    extract corresponding data we need to use from the original request
-    sent by localhost
+    the ETag and Last-Modified of a response, to revalidate it later
     """
-    data = data.decode('utf-8').split('\r\n')
-    request = data[0]
-    file_name = request.replace("/", " ")
-    request_data, host_name = extract_url(request.split(' ')[1])
-    remain_request = bytes('\r\n'.join(data[2:]), 'utf-8')
-    return request, file_name, request_data, host_name, remain_request
+    validators = {}
+    if b'etag' in headers:
+        validators['etag'] = headers[b'etag'].decode('latin-1')
+    if b'last-modified' in headers:
+        validators['last_modified'] = headers[b'last-modified'].decode('latin-1')
+    return validators
 
 
-def extract_url(url):
+def set_header(request, name, value):
     """
-    extract the host name and the request data from url
+    replace the header name of the request by "name: value", or add it after
+    the request line if the request does not have it
     """
-    print(url)
-    count = 0
-    index = 0
-    for i in range(len(url)):
-        if url[i] == '/':
-            count += 1
-        if count == 2:
-            index = i
+    lines = request.split(b'\r\n')
+    name, value = bytes(name, 'latin-1'), bytes(value, 'latin-1')
+    for i in range(1, len(lines)):
+        if lines[i].lower().startswith(name.lower() + b':'):
+            lines[i] = name + b': ' + value
             break
-    if count != 2:
-        return '/ ', url[1:]
-    return url[index:] + ' ', url[1:index]
+    else:
+        lines.insert(1, name + b': ' + value)
+    return b'\r\n'.join(lines)
 
 
-def change_accept_encoding(request):
+def make_conditional(request, validators):
     """
-    change the default http attribute Accept-Encoding from gzip to identity
+    make request ask the web server to answer 304 Not Modified if the page
+    still matches the validators of the cached copy
     """
-    request = request.decode('utf-8').split('\r\n')
-    for i in range(len(request)):
-        if request[i].startswith('Accept-Encoding'):
-            request[i] = 'Accept-Encoding: identity'
-    request = bytes('\r\n'.join(request), 'utf-8')
+    if 'etag' in validators:
+        request = set_header(request, 'If-None-Match', validators['etag'])
+    if 'last_modified' in validators:
+        request = set_header(request, 'If-Modified-Since', validators['last_modified'])
     return request
 
 
-def update_response(response, s):
+def make_banner(s):
     """
-    add the notification box, insert HTML code into somewhere in the 
-    <body> region of the HTTP response.
+    the notification box inserted into pages, as bytes
     """
     text = '<p style="z-index:9999; position:fixed; top:20px; left:20px; width:200px;height:100px; ' \
            'background-color:yellow; padding:10px; font-weight:bold;">{} {}</p>'
     text = text.format(s, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())))
-    response = response.decode('utf-8', 'ignore').split('\r\n')  # list
-    for i in range(len(response)):  # modify content-length
-        if response[i].startswith('Content-Length'):
-            length = int(response[i][16:]) + len(text)
-            response[i] = 'Content-Length: {}'.format(str(length))
-            break
-    html_code = response[-1]
-    html_code = html_code.split('\n')
-    for i in range(len(html_code)):    # modify html code, add notification box inside <body></body>
-        if html_code[i] == '</body>':
-            html_code.insert(i, text)
+    return bytes(text, 'utf-8')
+
+
+class BannerInjector:
+    """
+    Inserts banners before the first </body> of a page that arrives in
+    pieces, producing one copy of the page per banner in a single pass.
+    The page stays bytes, whatever its encoding; the last bytes of a piece
+    are held back in case a </body> is split across two pieces. A page
+    without </body> gets the banner at its end.
+    """
+    MARKER = b'</body>'
+
+    def __init__(self, banners):
+
+        self.banners = banners
+        self.held = b''
+        self.done = False
+
+    def feed(self, data):
+        """
+        return the part of every copy that can be sent after data arrived
+        """
+        if self.done:
+            return [data] * len(self.banners)
+        data = self.held + data
+        i = data.lower().find(self.MARKER)
+        if i >= 0:
+            self.done = True
+            self.held = b''
+            return [data[:i] + banner + data[i:] for banner in self.banners]
+        cut = max(0, len(data) - len(self.MARKER) + 1)
+        self.held = data[cut:]
+        return [data[:cut]] * len(self.banners)
+
+    def finish(self):
+        """
+        return the rest of every copy once the page is complete
+        """
+        if self.done:
+            return [b''] * len(self.banners)
+        self.done = True
+        return [self.held + banner for banner in self.banners]
+
+
+def set_content_length(head, length):
+    """
+    replace the Content-Length of a response head
+    """
+    lines = head.split(b'\r\n')
+    for i in range(1, len(lines)):
+        if lines[i].lower().startswith(b'content-length:'):
+            lines[i] = b'Content-Length: ' + bytes(str(length), 'utf-8')
+    return b'\r\n'.join(lines)
+
+
+def set_chunked(head):
+    """
+    make a response head announce a chunked body instead of its
+    Content-Length
+    """
+    lines = [line for line in head.split(b'\r\n') if not line.lower().startswith(b'content-length:')]
+    if not any(line.lower().startswith(b'transfer-encoding:') for line in lines):
+        lines.insert(1, b'Transfer-Encoding: chunked')
+    return b'\r\n'.join(lines)
+
+
+def set_close_delimited(head):
+    """
+    make a response head announce a body that ends when the connection
+    closes, for an HTTP/1.0 client, which does not know chunks
+    """
+    dropped = (b'content-length:', b'transfer-encoding:', b'connection:', b'keep-alive:')
+    lines = [line for line in head.split(b'\r\n') if not line.lower().startswith(dropped)]
+    lines.insert(1, b'Connection: close')
+    return b'\r\n'.join(lines)
+
+
+def parse_response_head(head):
+    """
+    return the status code of a response and a dict of its headers, with
+    lower case names; head is everything up to the blank line. Raise
+    ValueError if the status line is malformed
+    """
+    lines = head.split(b'\r\n')
+    fields = lines[0].split()
+    if len(fields) < 2 or not fields[0].startswith(b'HTTP/'):
+        raise ValueError('Bad status line: {!r}'.format(lines[0]))
+    status = int(fields[1])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def read_exactly(reader, size):
+    """
+    yield the next size bytes of reader, at most BUFFER_SIZE at a time
+    """
+    while size > 0:
+        data = await reader.read(min(size, BUFFER_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(data)
+        yield data
+
+
+def has_body(status):
+
+    return status >= 200 and status not in (204, 304)
+
+
+def is_chunked(headers):
+
+    return b'chunked' in headers.get(b'transfer-encoding', b'').lower()
+
+
+async def read_body(reader, status, headers, decode=False):
+    """
+    yield the body of a response as it arrives, unchanged, up to its end:
+    as given by Transfer-Encoding: chunked or Content-Length, or else when
+    the server closes the connection. With decode, a chunked body is
+    yielded without its chunk sizes and trailer.
+    """
+    if not has_body(status):
+        return
+    if is_chunked(headers):
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if not decode:
+                yield line
+            size = int(line.split(b';')[0], 16)
+            if size == 0:
+                break
+            async for data in read_exactly(reader, size):
+                yield data
+            line = await reader.readexactly(2)
+            if not decode:
+                yield line
+        while True:   # trailer, up to the blank line
+            line = await reader.readuntil(b'\r\n')
+            if not decode:
+                yield line
+            if line == b'\r\n':
+                break
+    elif b'content-length' in headers:
+        async for data in read_exactly(reader, int(headers[b'content-length'])):
+            yield data
+    else:
+        while True:
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def make_chunk(data):
+    """
+    data framed as one chunk of a chunked body, nothing if it is empty
+    (an empty chunk would end the body)
+    """
+    if not data:
+        return b''
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+def frame_chunks(pieces, chunked, last=False):
+    """
+    the next piece of every copy, as a chunk for the copies chunked tells
+    are sent in chunks; last ends their bodies
+    """
+    end = b'0\r\n\r\n' if last else b''
+    return [make_chunk(p) + end if c else p for p, c in zip(pieces, chunked)]
+
+
+def is_rechunked(headers):
+    """
+    whether inject_banner sends a response in chunks
+    """
+    return is_chunked(headers) or headers.get(b'content-encoding', b'').lower() in ENCODINGS
+
+
+async def inject_banner(reader, head, status, headers, banners, unframed=False):
+    """
+    yield the response with each of the banners inserted into the page, as
+    a list of the next piece of every copy; the Content-Length is updated,
+    a chunked body is sent as new chunks. With unframed, the first copy is
+    sent without chunks instead, ending when the connection closes
+    """
+    encoding = headers.get(b'content-encoding', b'').lower()
+    if encoding in ENCODINGS:
+        async for pieces in inject_banner_compressed(reader, head, status, headers, banners, encoding,
+                                                     unframed):
+            yield pieces
+        return
+    chunked = [is_chunked(headers)] * len(banners)   # per copy
+    if b'content-length' in headers and not chunked[0]:
+        length = int(headers[b'content-length'])
+        yield [set_content_length(head, length + len(banner)) for banner in banners]
+    elif chunked[0] and unframed:
+        chunked[0] = False
+        yield [set_close_delimited(head)] + [head] * (len(banners) - 1)
+    else:
+        yield [head] * len(banners)
+    injector = BannerInjector(banners)
+    async for data in read_body(reader, status, headers, decode=True):
+        yield frame_chunks(injector.feed(data), chunked)
+    yield frame_chunks(injector.finish(), chunked, last=True)
+
+
+def inflate(decompressor, data):
+    """
+    yield data decompressed, at most BUFFER_SIZE bytes at a time
+    """
+    while data:
+        yield decompressor.decompress(data, BUFFER_SIZE)
+        data = decompressor.unconsumed_tail
+
+
+async def inject_banner_compressed(reader, head, status, headers, banners, encoding, unframed=False):
+    """
+    inject_banner for a gzip or deflate page: the page is decompressed as it
+    arrives, the banners are inserted and every copy is compressed again
+    and sent in chunks, since its length is not known in advance, or with
+    unframed, the first copy until the connection closes. The copies are
+    the same up to the banner, so they share one compressor until then
+    """
+    chunked = [not unframed] + [True] * (len(banners) - 1)
+    yield [set_chunked(head) if c else set_close_delimited(head) for c in chunked]
+    wbits = ENCODINGS[encoding]
+    decompressor = zlib.decompressobj(47)   # gzip or zlib, told by the header
+    started = False
+    shared = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+    compressors = None   # one per banner, once the copies differ
+    injector = BannerInjector(banners)
+
+    def compress(pieces):
+        nonlocal compressors
+        if compressors is None and all(p is pieces[0] for p in pieces):
+            return [shared.compress(pieces[0])] * len(pieces)
+        if compressors is None:
+            compressors = [shared.copy() for _ in pieces]
+        return [c.compress(p) for c, p in zip(compressors, pieces)]
+
+    async for data in read_body(reader, status, headers, decode=True):
+        if not started and encoding == b'deflate' and data:
+            started = True
+            try:
+                zlib.decompressobj(47).decompress(data[:2])
+            except zlib.error:   # raw deflate, without the zlib header
+                decompressor = zlib.decompressobj(-15)
+        for plain in inflate(decompressor, data):
+            yield frame_chunks(compress(injector.feed(plain)), chunked)
+    rest = injector.feed(decompressor.flush())
+    pieces = [p + q for p, q in zip(rest, injector.finish())]
+    pieces = compress([pieces[0]] * len(pieces) if all(p == pieces[0] for p in pieces) else pieces)
+    if compressors is None:
+        pieces = [p + shared.flush() for p in pieces]
+    else:
+        pieces = [p + c.flush() for p, c in zip(pieces, compressors)]
+    yield frame_chunks(pieces, chunked, last=True)
+
+
+def is_framed(status, headers):
+    """
+    whether the end of a response can be told without the connection closing
+    """
+    return not has_body(status) or is_chunked(headers) or b'content-length' in headers
+
+
+def can_reuse(head, status, headers):
+    """
+    whether the connection a response came on can carry another request
+    once the response has been read
+    """
+    connection = headers.get(b'connection', b'').lower()
+    framed = is_framed(status, headers)
+    if head.startswith(b'HTTP/1.0'):
+        return framed and b'keep-alive' in connection
+    return framed and b'close' not in connection
+
+
+async def send_request(pool, host, port, request):
+    """
+    send request over a pooled connection to host and return the connection
+    and the head of the response; a reused connection that the server
+    closed in the meantime is replaced by a new one
+    """
+    while True:
+        start = time.perf_counter()
+        reader, writer, reused = await pool.acquire(host, port)
+        metrics.observe('proxy_origin_connect_seconds', time.perf_counter() - start)
+        metrics.inc('proxy_origin_connections_total', reused=str(reused).lower())
+        try:
+            writer.write(request)
+            await writer.drain()
+            head = await reader.readuntil(b'\r\n\r\n')
+            metrics.observe('proxy_origin_first_byte_seconds', time.perf_counter() - start)
+            return reader, writer, head
+        except (IOError, EOFError):
+            pool.release(host, port, reader, writer, False)
+            if not reused:
+                raise
+        except BaseException:   # head over the reader's limit, or cancelled
+            pool.release(host, port, reader, writer, False)
+            raise
+
+
+class Unchunker:
+    """
+    Turns a stored response, read in pieces, into the copy sent to an
+    HTTP/1.0 client, which does not know chunks: a chunked body loses its
+    chunk sizes and trailer, under a head that says the body ends when the
+    connection closes. Any other response is passed on unchanged.
+    """
+    def __init__(self):
+
+        self.buffer = b''       # the start of a head or chunk size line
+        self.state = 'head'     # head, size, data, crlf, trailer, done, or rest if not chunked
+        self.left = 0           # bytes of the current chunk still to come
+        self.unframed = False   # whether the body ends when the connection closes
+
+    def feed(self, data):
+        """
+        the bytes to send for the next piece of the stored response
+        """
+        if self.state == 'rest':
+            return data
+        buffer = self.buffer + data if self.buffer else data
+        out = []
+        pos = 0
+        while True:
+            if self.state == 'head':
+                end = buffer.find(b'\r\n\r\n', pos)
+                if end < 0:
+                    break
+                head = buffer[pos:end + 4]
+                pos = end + 4
+                status, headers = parse_response_head(head)
+                if has_body(status) and is_chunked(headers):
+                    self.unframed = True
+                    self.state = 'size'
+                    out.append(set_close_delimited(head))
+                else:
+                    self.state = 'rest'
+                    out.append(head)
+            elif self.state == 'rest':
+                out.append(buffer[pos:])
+                pos = len(buffer)
+                break
+            elif self.state == 'data':
+                if pos == len(buffer):
+                    break
+                piece = buffer[pos:pos + self.left]
+                out.append(piece)
+                pos += len(piece)
+                self.left -= len(piece)
+                if self.left == 0:
+                    self.state = 'crlf'
+            elif self.state == 'crlf':
+                if len(buffer) - pos < 2:
+                    break
+                pos += 2
+                self.state = 'size'
+            elif self.state in ('size', 'trailer'):
+                end = buffer.find(b'\r\n', pos)
+                if end < 0:
+                    break
+                line = buffer[pos:end]
+                pos = end + 2
+                if self.state == 'size':
+                    self.left = int(line.split(b';')[0], 16)
+                    self.state = 'data' if self.left else 'trailer'
+                elif not line:
+                    self.state = 'done'
+            else:   # done
+                pos = len(buffer)
+                break
+        self.buffer = buffer[pos:]
+        return b''.join(out)
+
+
+class Fetch:
+    """
+    A response being fetched from a web server into the cache. Requests for
+    the same response that arrive meanwhile follow it, by sending the
+    partial cache file as it grows, instead of fetching it again.
+    """
+    def __init__(self, cache_writer):
+
+        self.cache_writer = cache_writer
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self.revalidated = False    # the web server answered 304, the cached copy is still good
+        self.task = None    # the task of a background refresh
+        self.changed = asyncio.Event()
+
+    def write(self, data):
+
+        self.cache_writer.write(data)
+        self.size += len(data)
+        self.notify()
+
+    def finish(self, complete):
+        """
+        store the response if it is complete, else drop it
+        """
+        if complete:
+            self.cache_writer.commit()
+        else:
+            self.cache_writer.abort()
+        self.done = True
+        self.failed = not complete
+        self.notify()
+
+    def notify(self):
+
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self, writer, unchunker=None):
+        """
+        send the response to writer as it is fetched, through unchunker if
+        given; return whether all of it could be sent
+        """
+        loop = asyncio.get_running_loop()
+        offset = 0
+        with open(self.cache_writer.partial, 'rb') as f:
+            while True:
+                if offset < self.size:
+                    count = self.size - offset
+                    if unchunker is None:
+                        await loop.sendfile(writer.transport, f, offset, count)
+                    else:
+                        f.seek(offset)
+                        await send_unchunked(writer, unchunker, f, count)
+                    metrics.inc('proxy_sent_bytes_total', count, source='coalesced')
+                    offset += count
+                elif self.done:
+                    return not self.failed
+                else:
+                    await self.changed.wait()
+
+
+async def send_unchunked(writer, unchunker, f, count):
+    """
+    send the next count bytes of the stored response in f through unchunker
+    """
+    while count > 0:
+        data = f.read(min(count, BUFFER_SIZE))
+        if not data:
             break
-    if i == len(html_code) - 1:   # bad html code without </body> tag, add notification box in the front of the doc
-        html_code.insert(0, text)
-    html_code = '\n'.join(html_code)
-    response[-1] = html_code
-    response = '\r\n'.join(response)
-    response = bytes(response, 'utf-8')
-    return response
-
-
-def data_handler(s, expire_time, inputs):
-    """
-    receive HTTP request
-    create a new client socket that connects to the destination web server,
-    and forward the HTTP request
-    """
-    data = s.recv(1024)
-    if data:
-        request, file_name, request_data, host_name, remain_request = extra_info_from_data(data)
-        if os.path.isfile(file_name) and \
-                float(os.path.getmtime(file_name)) + expire_time >= float(time.time()):
-            f = open(file_name, "rb")
-            s.send(f.read())
-            f.close()
+        count -= len(data)
+        writer.write(unchunker.feed(data))
+        await writer.drain()
+
+
+async def send_cached(writer, cache, key, unchunker=None):
+    """
+    send the cached response of key, through unchunker if given; return
+    False if it is gone
+    """
+    cached = cache.get(key)
+    if cached is not None:
+        writer.write(cached if unchunker is None else unchunker.feed(cached))
+        await writer.drain()
+        metrics.inc('proxy_sent_bytes_total', len(cached), source='cache')
+        return True
+    f = cache.open(key)
+    if f is None:
+        return False
+    with f:
+        if unchunker is None:   # large response, sent from the file by the kernel
+            count = await asyncio.get_running_loop().sendfile(writer.transport, f)
+        else:
+            count = os.fstat(f.fileno()).st_size
+            await send_unchunked(writer, unchunker, f, count)
+    metrics.inc('proxy_sent_bytes_total', count, source='cache')
+    return True
+
+
+async def send_error(writer, status):
+    """
+    answer a request the proxy cannot serve with an empty response, and
+    tell the client the connection closes
+    """
+    metrics.inc('proxy_errors_total', status=status[:3].decode())
+    writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+    await writer.drain()
+
+
+async def fetch_response(fetch, key, request, host_name, cache, pool, writer=None, validators=None,
+                         version=b'HTTP/1.1'):
+    """
+    fetch the response to request from the web server into the cache and
+    send it to writer, if any, as it arrives; fetch is the Fetch registered
+    in fetches for key, removed once the response is complete. With the
+    validators of an expired copy, the web server is asked whether it
+    changed, and the copy is kept if it did not. writer gets 502 if the
+    fetch fails before any of the response was sent. version is the HTTP
+    version of the client's request: an HTTP/1.0 client gets a response
+    that would be sent in chunks until its connection closes instead.
+    Return whether writer got the whole response and its connection can
+    carry another one
+    """
+    complete = False
+    reusable = False
+    not_modified = False
+    connected = False
+    answered = False    # whether anything was sent to writer
+    unframed = False    # whether writer's copy ends when its connection closes
+    start = time.perf_counter()
+    try:
+        web_reader, web_writer, head = await send_request(pool, host_name, origin_port,
+                                                          make_conditional(request, validators or {}))
+        connected = True
+        status, headers = parse_response_head(head)
+        if validators:
+            metrics.inc('proxy_revalidations_total', result='not_modified' if status == 304 else 'modified')
+        if status == 304 and validators:
+            not_modified = True
+            fetch.revalidated = cache.refresh(key, get_validators(headers))
+            reusable = can_reuse(head, status, headers)
         else:
+            fetch.cache_writer.validators = get_validators(headers)
+            sampled = nullcontext()
+            if bytes('Referer: ', 'utf-8') not in request and has_body(status):  # step5 modify html code
+                banners = [make_banner('FRESH VERSION AT:'), make_banner('CACHED VERSION AS OF:')]
+                unframed = version == b'HTTP/1.0' and is_rechunked(headers)
+                pieces = inject_banner(web_reader, head, status, headers, banners, unframed)
+                sampled = profiler.sampled()
+            else:
+                unframed = version == b'HTTP/1.0' and has_body(status) and is_chunked(headers)
+                pieces = read_response(web_reader, head, status, headers, unframed)
+            with sampled:
+                async for fresh, cached in pieces:
+                    fetch.write(cached)
+                    if writer is not None:
+                        answered = True
+                        writer.write(fresh)
+                        metrics.inc('proxy_sent_bytes_total', len(fresh), source='origin')
+                        try:
+                            await writer.drain()
+                        except ConnectionError:   # keep fetching for the cache and the followers
+                            writer = None
+            # a response that ends when the web server closes the connection
+            # cannot be followed by another on the client's connection, and
+            # is not cached since a cache hit would have the same problem
+            complete = is_framed(status, headers)
+            reusable = can_reuse(head, status, headers)
+        metrics.observe('proxy_origin_response_seconds', time.perf_counter() - start)
+
+    # connection lost, or bad response; LimitOverrunError is a head or chunk
+    # size line over the reader's limit
+    except (IOError, EOFError, ValueError, zlib.error, asyncio.LimitOverrunError):
+        print(host_name)
+        metrics.inc('proxy_origin_errors_total')
+    finally:
+        if connected:
+            pool.release(host_name, origin_port, web_reader, web_writer, reusable)
+        fetch.finish(complete)
+        del fetches[key]
+    if not complete and not not_modified and not answered and writer is not None:
+        await send_error(writer, b'502 Bad Gateway')
+        return False
+    if not_modified and writer is not None:
+        return await send_revalidated(fetch, key, request, host_name, cache, pool, writer, version)
+    return complete and writer is not None and not unframed
+
+
+async def send_revalidated(fetch, key, request, host_name, cache, pool, writer, version=b'HTTP/1.1'):
+    """
+    send the cached copy the web server said is still good; fetch it again
+    if it was evicted in the meantime
+    """
+    unchunker = Unchunker() if version == b'HTTP/1.0' else None
+    if fetch.revalidated and await send_cached(writer, cache, key, unchunker):
+        return unchunker is None or not unchunker.unframed
+    fetch = fetches[key] = Fetch(cache.store(key))
+    return await fetch_response(fetch, key, request, host_name, cache, pool, writer, version=version)
+
+
+async def read_response(reader, head, status, headers, unframed=False):
+    """
+    yield the response unchanged, as [piece, piece] pairs like inject_banner;
+    with unframed, the first copy of a chunked response is sent without
+    chunks instead, ending when the connection closes
+    """
+    if not (unframed and is_chunked(headers)):
+        yield [head, head]
+        async for data in read_body(reader, status, headers):
+            yield [data, data]
+        return
+    chunked = [False, True]
+    yield [set_close_delimited(head), head]
+    async for data in read_body(reader, status, headers, decode=True):
+        yield frame_chunks([data, data], chunked)
+    yield frame_chunks([b'', b''], chunked, last=True)
+
+
+async def data_handler(head, reader, writer, cache, pool):
+    """
+    answer one HTTP request read from a client, either from the cache or by
+    forwarding it to the destination web server; the connection to the web
+    server is made without blocking the other clients, and the response is
+    sent to the client and the cache as it arrives. Only one request at a
+    time fetches a response, the others follow it. An expired response is
+    still sent for another expire_time, while it is refreshed in the
+    background; expired responses are revalidated rather than fetched again
+    when they have validators. Return whether the client connection can
+    carry another request
+    """
+    try:
+        version, host_name, path, header_lines, headers = parse_request(head)
+        if b'content-length' in headers:   # the body of a request is not forwarded
+            async for _ in read_exactly(reader, int(headers[b'content-length'])):
+                pass
+        elif is_chunked(headers):
+            async for _ in read_body(reader, 200, headers):
+                pass
+    except ValueError:
+        await send_error(writer, b'400 Bad Request')
+        return False
+    except asyncio.IncompleteReadError:   # closed by the client
+        return False
+    if host_name == ADMIN_HOST:
+        return await admin_handler(path, writer) and wants_keep_alive(version, headers)
+    if verbose:
+        print('/' + host_name + path)
+    keep_alive = wants_keep_alive(version, headers)
+    # compressed pages are cached in chunks, which HTTP/1.0 clients do not know
+    encoding = accepted_encoding(headers) if version != b'HTTP/1.0' else 'identity'
+    request = make_request(host_name, path, header_lines, encoding)
+    key = cache_key(host_name, path, bytes('Referer: ', 'utf-8') not in request, encoding)
+
+    entry = cache.lookup(key)
+    fetch = fetches.get(key)
+    fresh = entry is not None and cache.is_fresh(entry)
+    if entry is not None and not fresh and cache.is_usable_stale(entry) and fetch is None:
+        fetch = fetches[key] = Fetch(cache.store(key))
+        fetch.task = asyncio.create_task(fetch_response(fetch, key, request, host_name, cache, pool,
+                                                        validators=entry.validators))
+    # stored responses are sent to HTTP/1.0 clients without chunks, until
+    # the connection closes
+    unchunker = Unchunker() if version == b'HTTP/1.0' else None
+    if entry is not None and (fresh or cache.is_usable_stale(entry)) and \
+            await send_cached(writer, cache, key, unchunker):
+        metrics.inc('proxy_cache_requests_total', result='hit' if fresh else 'stale')
+        return keep_alive and (unchunker is None or not unchunker.unframed)
+    if fetch is not None:
+        metrics.inc('proxy_cache_requests_total', result='coalesced')
+        if await fetch.follow(writer, unchunker) or \
+                (fetch.revalidated and await send_cached(writer, cache, key, unchunker)):
+            return keep_alive and (unchunker is None or not unchunker.unframed)
+        print(host_name)
+        if fetch.size == 0:
+            await send_error(writer, b'502 Bad Gateway')
+        return False
+    metrics.inc('proxy_cache_requests_total', result='miss' if entry is None else 'expired')
+    fetch = fetches[key] = Fetch(cache.store(key))
+    return await fetch_response(fetch, key, request, host_name, cache, pool, writer,
+                                None if entry is None else entry.validators, version) and keep_alive
+
+
+async def admin_handler(path, writer):
+    """
+    answer a request for /ADMIN_HOST/path from a local client: metrics
+    gives the metrics in the Prometheus text format; profile gives the
+    profile of the sampled calls of data_handler and inject_banner, and
+    profile/start?rate=R, profile/stop and profile/reset control the
+    sampling without restarting the proxy. Return whether the connection
+    can carry another request
+    """
+    peer = writer.get_extra_info('peername')
+    if peer is None or not ipaddress.ip_address(peer[0]).is_loopback:
+        await send_error(writer, b'403 Forbidden')
+        return False
+    url = urlsplit(path)
+    query = parse_qs(url.query)
+    if url.path == '/metrics':
+        body = metrics.render()
+    elif url.path in ('/profile', '/profile/start', '/profile/stop', '/profile/reset'):
+        if url.path == '/profile/start':
             try:
-                web_ser_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                web_ser_socket.connect((host_name, 80))
-                request = bytes('GET' + ' ' + request_data + 'HTTP/1.1' + '\r\nHost: '
-                                + host_name + '\r\n', "utf-8") + remain_request
-                request = change_accept_encoding(request)  # change default accept encoding to identity
-                web_ser_socket.send(request)
-                response = cache_data = web_ser_socket.recv(10000000)
-                if bytes('Referer: ', 'utf-8') not in request:  # step5 modify html code
-                    response = update_response(response, 'FRESH VERSION AT:')
-                    cache_data = update_response(response, 'CACHED VERSION AS OF:')
-                f = open(file_name, "wb")
-                f.write(cache_data)
-                s.send(response)
-                web_ser_socket.close()
-                f.close()
-
-            except IOError:
-                print(host_name)
+                profiler.start(float(query['rate'][0]) if 'rate' in query else profiler.rate or PROFILE_RATE)
+            except ValueError:
+                await send_error(writer, b'400 Bad Request')
+                return False
+        elif url.path == '/profile/stop':
+            profiler.stop()
+        elif url.path == '/profile/reset':
+            profiler.reset()
+        body = profiler.report()
     else:
-        inputs.remove(s)
+        await send_error(writer, b'404 Not Found')
+        return False
+    body = bytes(body, 'utf-8')
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                 b'Cache-Control: no-store\r\nContent-Length: ' + bytes(str(len(body)), 'utf-8') +
+                 b'\r\n\r\n' + body)
+    await writer.drain()
+    return True
+
+
+async def client_handler(reader, writer, cache, pool):
+    """
+    serve the requests of one client connection until the client closes it;
+    requests are read as they arrive and answered in order, so a client can
+    send the next ones without waiting for the responses
+    """
+    clients[writer] = {'address': writer.get_extra_info('peername'), 'requests': 0}
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:   # closed by the client
+                break
+            except asyncio.LimitOverrunError:
+                await send_error(writer, b'431 Request Header Fields Too Large')
+                break
+            clients[writer]['requests'] += 1
+            metrics.inc('proxy_requests_total')
+            start = time.perf_counter()
+            with profiler.sampled():
+                keep_alive = await data_handler(head, reader, writer, cache, pool)
+            metrics.observe('proxy_request_seconds', time.perf_counter() - start)
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        del clients[writer]
+        writer.close()
+
+
+async def serve(cache, host='localhost', port=8888, reuse_port=False):
+    """
+    accept client connections and run a client_handler task for each one
+    """
+    pool = OriginPool()
+    reaper = asyncio.create_task(pool.reap_forever())   # referenced so it is not garbage collected
+    metrics.gauge('proxy_client_connections', lambda: len(clients))
+    metrics.gauge('proxy_fetches_in_progress', lambda: len(fetches))
+    metrics.gauge('proxy_origin_connections_idle', lambda: sum(len(idle) for idle in pool.idle.values()))
+    metrics.gauge('proxy_cache_entries', lambda: len(cache.index))
+    metrics.gauge('proxy_cache_memory_bytes', lambda: cache.memory_used)
+    metrics.gauge('proxy_cache_disk_bytes', lambda: cache.disk_used)
+    server = await asyncio.start_server(lambda reader, writer: client_handler(reader, writer, cache, pool),
+                                        sock=init_server_sock(host, port, reuse_port))
+    async with server:
+        await server.serve_forever()
+
+
+def run_workers(cache, args):
+    """
+    fork args.workers processes serving the same port and wait for them;
+    they share cache, whose index they keep in sync through its journal
+    """
+    workers = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                asyncio.run(serve(cache, args.host, args.port, reuse_port=True))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        workers.append(pid)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)   # stop the workers too
+    try:
+        for pid in workers:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 
 def main():
     """
-    main program of running socket server
+    main program of running socket server; asyncio waits on the sockets with
+    the best selector of the platform (epoll on Linux)
     """
-    server = init_server_sock()
-    inputs = [server]
-    outputs = []
-    expire_time = float(sys.argv[1])
-    while True:
-        # use select to select socket that has data
-        readable, writable, exceptional = select.select(inputs, outputs, inputs)
-        for s in readable:
-            if s is server:  # if it's server socket then accept connection
-                connection, client_address = s.accept()
-                connection.setblocking(0)
-                inputs.append(connection)
-            else:
-                data_handler(s, expire_time, inputs)
+    parser = argparse.ArgumentParser(description='Caching web proxy')
+    parser.add_argument('expire_time', type=float, help='seconds a cached response stays fresh')
+    parser.add_argument('--host', default='localhost', help='address to listen on (default localhost)')
+    parser.add_argument('--port', type=int, default=8888, help='port to listen on (default 8888)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes (default 1)')
+    parser.add_argument('--origin-port', type=int, default=80,
+                        help='port of the web servers (default 80), e.g. for a local test server')
+    parser.add_argument('--verbose', action='store_true', help='print the URL of every request')
+    args = parser.parse_args()
+
+    global origin_port, verbose
+    origin_port = args.origin_port
+    verbose = args.verbose
+
+    cache = Cache(args.expire_time)
+    if args.workers > 1:
+        run_workers(cache, args)
+    else:
+        asyncio.run(serve(cache, args.host, args.port))
 
 
 if __name__ == "__main__":   # main program
     main()
-
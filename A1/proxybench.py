@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+from proxy import parse_response_head, read_body
+
+# Last-Modified of every page of the origin stand-in, so the proxy can
+# revalidate them
+LAST_MODIFIED = b'Thu, 01 Jan 2026 00:00:00 GMT'
+
+
+def free_port():
+    """
+    a TCP port nobody listens on right now
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_page(size):
+    """
+    an HTML page of about size bytes
+    """
+    start, end = b'<html><body>\n', b'\n</body></html>\n'
+    return start + b'x' * max(0, size - len(start) - len(end)) + end
+
+
+async def origin_handler(reader, writer, size, delay, counter):
+    """
+    answer the keep-alive requests of one connection to the origin stand-in:
+    every page is size bytes long and is sent after delay seconds, or 304
+    if the request has If-Modified-Since
+    """
+    page = make_page(size)
+    try:
+        while True:
+            request = await reader.readuntil(b'\r\n\r\n')
+            with counter.get_lock():
+                counter.value += 1
+            await asyncio.sleep(delay)
+            if b'\r\nif-modified-since:' in request.lower():
+                writer.write(b'HTTP/1.1 304 Not Modified\r\nLast-Modified: ' + LAST_MODIFIED + b'\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nLast-Modified: ' + LAST_MODIFIED +
+                             b'\r\nContent-Length: ' + bytes(str(len(page)), 'utf-8') + b'\r\n\r\n' + page)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_origin(port, size, delay, counter):
+    """
+    run the origin stand-in on port, counting the requests it gets
+    """
+    async def serve():
+        server = await asyncio.start_server(lambda r, w: origin_handler(r, w, size, delay, counter),
+                                            '127.0.0.1', port)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def wait_for_port(port, timeout=10.0):
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Nothing listening on port {}'.format(port))
+
+
+async def client(port, paths, requests, referer, latencies):
+    """
+    send requests requests for random paths over one keep-alive
+    connection to the proxy, one after the other, recording the latency of
+    each in latencies
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    extra = b'Referer: bench\r\n' if referer else b''
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(b'GET ' + random.choice(paths) + b' HTTP/1.1\r\nHost: 127.0.0.1\r\n' + extra + b'\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        status, headers = parse_response_head(head)
+        async for _ in read_body(reader, status, headers):
+            pass
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def drive(port, clients, requests, paths, referer):
+    """
+    run clients concurrent clients sending requests requests in all;
+    return the latencies and the wall time
+    """
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, paths, requests // clients + (i < requests % clients), referer, latencies)
+                           for i in range(clients)])
+    return latencies, time.perf_counter() - start
+
+
+def peak_rss_kib(pid):
+    """
+    peak resident memory of process pid and its children, from /proc
+    """
+    total = 0
+    pids = [pid]
+    try:
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open('/proc/{}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, p):
+    """
+    the p-quantile of sorted values, nearest rank
+    """
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark proxy.py against a local origin stand-in')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent keep-alive clients (default 50)')
+    parser.add_argument('--requests', type=int, default=5000, help='requests in all (default 5000)')
+    parser.add_argument('--urls', type=int, default=100, help='distinct pages requested (default 100)')
+    parser.add_argument('--size', type=int, default=16 * 1024, help='page size in bytes (default 16384)')
+    parser.add_argument('--delay', type=float, default=0.01, help='origin delay in seconds (default 0.01)')
+    parser.add_argument('--expire', type=float, default=60, help='proxy expire_time (default 60)')
+    parser.add_argument('--workers', type=int, default=1, help='proxy worker processes (default 1)')
+    parser.add_argument('--referer', action='store_true', help='send a Referer, so no banner is injected')
+    args = parser.parse_args()
+
+    origin_port, proxy_port = free_port(), free_port()
+    counter = multiprocessing.Value('l', 0)
+    origin = multiprocessing.Process(target=run_origin, args=(origin_port, args.size, args.delay, counter),
+                                     daemon=True)
+    origin.start()
+    workdir = tempfile.TemporaryDirectory()
+    proxy = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy.py'),
+                              str(args.expire), '--port', str(proxy_port), '--origin-port', str(origin_port),
+                              '--workers', str(args.workers)],
+                             cwd=workdir.name, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(origin_port)
+        wait_for_port(proxy_port)
+        paths = [bytes('/127.0.0.1/page{}.html'.format(i), 'utf-8') for i in range(args.urls)]
+        latencies, wall = asyncio.run(drive(proxy_port, args.clients, args.requests, paths, args.referer))
+        rss = peak_rss_kib(proxy.pid)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        origin.terminate()
+        workdir.cleanup()
+
+    latencies.sort()
+    print('requests     {}'.format(len(latencies)))
+    print('requests/s   {:.0f}'.format(len(latencies) / wall))
+    print('p50          {:.2f} ms'.format(percentile(latencies, 0.50) * 1000))
+    print('p99          {:.2f} ms'.format(percentile(latencies, 0.99) * 1000))
+    print('p999         {:.2f} ms'.format(percentile(latencies, 0.999) * 1000))
+    print('hit ratio    {:.3f}'.format(1 - counter.value / len(latencies)))
+    print('peak RSS     {:.1f} MiB'.format(rss / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import os
+import time
+import json
+import fcntl
+import hashlib
+import itertools
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# default location and sizes of the two cache tiers
+CACHE_DIR = 'cache'
+MEMORY_BUDGET = 64 * 1024 * 1024    # bytes of responses kept in memory
+DISK_BUDGET = 1024 * 1024 * 1024    # bytes of responses kept in CACHE_DIR
+# larger responses are not copied into memory on a disk hit, they are sent
+# straight from their file
+MEMORY_OBJECT_LIMIT = 256 * 1024
+# files in the cache directory besides the responses: the journal of
+# index changes shared by all worker processes, the lock serializing
+# writes to it, and the directory of responses still being received
+JOURNAL_NAME = 'index.journal'
+LOCK_NAME = 'index.lock'
+PARTIAL_DIR = 'tmp'
+# the journal is rewritten from the index when it has this many times more
+# records than the index has entries
+COMPACT_FACTOR = 4
+
+# numbers the partial files of this process
+partial_ids = itertools.count()
+
+
+class CacheEntry:
+    """
+    what the index knows about one cached response; validators holds its
+    ETag and Last-Modified, if the web server sent them
+    """
+    __slots__ = ('size', 'stored_time', 'validators')
+
+    def __init__(self, size, stored_time, validators=None):
+
+        self.size = size
+        self.stored_time = stored_time
+        self.validators = validators
+
+    def record(self, key):
+        """
+        the journal record that adds this entry
+        """
+        record = {'op': 'put', 'key': key, 'size': self.size, 'time': self.stored_time}
+        if self.validators:
+            record['validators'] = self.validators
+        return record
+
+
+class Cache:
+    """
+    Two-tier response cache. Every response is written to a file in
+    directory, named after the SHA-256 of its key and spread over two levels
+    of 256 subdirectories; the most recently used ones are also kept in
+    memory. Both tiers
+    evict their least recently used responses when they go over budget.
+    The index remembers when each response was stored, so checking freshness
+    does not touch the file system, and is loaded from the journal at
+    startup rather than by listing the directory.
+
+    Several worker processes can share the directory. Every change to the
+    index is appended to a journal, under a file lock, and each process
+    replays the records of the others before a lookup misses. A Cache made
+    before forking the workers is used by all of them.
+    """
+    def __init__(self, expire_time, directory=CACHE_DIR, memory_budget=MEMORY_BUDGET, disk_budget=DISK_BUDGET):
+
+        self.expire_time = expire_time
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+
+        # self.index: key -> CacheEntry of every response on disk, least
+        # recently used first; self.memory: key -> response, same order
+        self.index = OrderedDict()
+        self.memory = OrderedDict()
+        self.disk_used = 0
+        self.memory_used = 0
+
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        self.journal = None
+        self.journal_inode = None
+        self.journal_offset = 0     # bytes of the journal replayed
+        self.journal_records = 0
+        self.lock_file = None
+        self.lock_pid = None
+
+        partial_dir = os.path.join(directory, PARTIAL_DIR)
+        os.makedirs(partial_dir, exist_ok=True)
+        for name in os.listdir(partial_dir):   # interrupted while being received
+            os.remove(os.path.join(partial_dir, name))
+        with self.locked():
+            if os.path.exists(self.journal_path):
+                self.sync()
+            else:
+                self.compact()
+        self.evict_disk()
+
+    @contextmanager
+    def locked(self):
+        """
+        hold the journal lock; the lock file is opened again in every process,
+        since flock() locks are shared by forked processes
+        """
+        if self.lock_pid != os.getpid():
+            self.lock_file = open(os.path.join(self.directory, LOCK_NAME), 'a')
+            self.lock_pid = os.getpid()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def sync(self):
+        """
+        apply the journal records written since the last sync, starting over
+        if the journal was compacted meanwhile
+        """
+        try:
+            inode = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self.journal_inode:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, 'a+b')
+            self.journal_inode = inode
+            self.journal_offset = 0
+            self.journal_records = 0
+            self.index.clear()
+            self.memory.clear()
+            self.disk_used = 0
+            self.memory_used = 0
+        size = os.fstat(self.journal.fileno()).st_size
+        if size <= self.journal_offset:
+            return
+        data = os.pread(self.journal.fileno(), size - self.journal_offset, self.journal_offset)
+        data = data[:data.rfind(b'\n') + 1]    # only whole records
+        self.journal_offset += len(data)
+        for line in data.splitlines():
+            self.apply(json.loads(line))
+            self.journal_records += 1
+
+    def apply(self, record):
+        """
+        change the index as a journal record says, unless it already has
+        """
+        key = record['key']
+        old = self.index.get(key)
+        if record['op'] == 'put':
+            if old is not None and old.stored_time == record['time'] and old.size == record['size']:
+                return
+            self.forget(key)
+            if old is not None:
+                self.disk_used -= old.size
+                self.index.move_to_end(key)
+            self.index[key] = CacheEntry(record['size'], record['time'], record.get('validators'))
+            self.disk_used += record['size']
+        elif old is not None:
+            self.forget(key)
+            del self.index[key]
+            self.disk_used -= old.size
+
+    def append(self, record):
+        """
+        append a record to the journal, which has just been synced; needs
+        the lock
+        """
+        line = bytes(json.dumps(record) + '\n', 'utf-8')
+        self.journal.write(line)
+        self.journal.flush()
+        self.journal_offset += len(line)
+        self.journal_records += 1
+        if self.journal_records > COMPACT_FACTOR * (len(self.index) + 100):
+            self.compact()
+
+    def compact(self):
+        """
+        rewrite the journal as one record per entry of the index; needs the
+        lock
+        """
+        partial = os.path.join(self.directory, PARTIAL_DIR, JOURNAL_NAME)
+        with open(partial, 'wb') as f:
+            for key, entry in self.index.items():
+                f.write(bytes(json.dumps(entry.record(key)) + '\n', 'utf-8'))
+        os.replace(partial, self.journal_path)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'a+b')
+        self.journal_inode = os.fstat(self.journal.fileno()).st_ino
+        self.journal_offset = os.fstat(self.journal.fileno()).st_size
+        self.journal_records = len(self.index)
+
+    def path(self, key):
+        """
+        the file holding the response of key
+        """
+        digest = hashlib.sha256(bytes(key, 'utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def lookup(self, key):
+        """
+        return the CacheEntry of key, or None if it is not cached; the
+        journal is read first if this process does not have a fresh entry
+        """
+        entry = self.index.get(key)
+        if entry is None or not self.is_fresh(entry):
+            self.sync()
+            entry = self.index.get(key)
+        return entry
+
+    def is_fresh(self, entry):
+
+        return entry.stored_time + self.expire_time >= time.time()
+
+    def is_usable_stale(self, entry):
+        """
+        whether the response can still be sent while it is refreshed: for
+        expire_time after it expired
+        """
+        return entry.stored_time + 2 * self.expire_time >= time.time()
+
+    def get(self, key):
+        """
+        return the cached response of key from the memory tier, reading it
+        from disk first if it is at most MEMORY_OBJECT_LIMIT bytes; None if
+        it is not cached or should be sent with open() instead
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        self.index.move_to_end(key)
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            return data
+        if entry.size > MEMORY_OBJECT_LIMIT:
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:   # removed behind our back
+            self.remove(key)
+            return None
+        self.remember(key, data)
+        return data
+
+    def open(self, key):
+        """
+        return the file of the cached response of key opened for reading,
+        or None if it is not cached
+        """
+        if key not in self.index:
+            return None
+        self.index.move_to_end(key)
+        try:
+            return open(self.path(key), 'rb')
+        except OSError:
+            self.remove(key)
+            return None
+
+    def put(self, key, data):
+        """
+        store the response of key in both tiers
+        """
+        writer = self.store(key)
+        writer.write(data)
+        writer.commit()
+
+    def store(self, key):
+        """
+        return a CacheWriter to store the response of key piece by piece
+        """
+        return CacheWriter(self, key)
+
+    def add(self, key, partial, size, data=None, validators=None):
+        """
+        move the file partial, holding the response of key, into the cache
+        and index it; data is the response itself if it should also go to
+        the memory tier
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.locked():
+            self.sync()
+            os.replace(partial, path)
+            self.forget(key)
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.disk_used -= old.size
+            entry = self.index[key] = CacheEntry(size, time.time(), validators)
+            self.disk_used += size
+            self.append(entry.record(key))
+        self.evict_disk()
+        if data is not None and key in self.index:
+            self.remember(key, data)
+
+    def refresh(self, key, validators=None):
+        """
+        make the response of key fresh again, after the web server said it
+        has not changed; validators replace the stored ones if given. Return
+        False if the response is no longer cached
+        """
+        with self.locked():
+            self.sync()
+            old = self.index.get(key)
+            if old is None:
+                return False
+            entry = self.index[key] = CacheEntry(old.size, time.time(), validators or old.validators)
+            self.index.move_to_end(key)
+            self.append(entry.record(key))
+        return True
+
+    def remove(self, key):
+        """
+        drop key from both tiers
+        """
+        self.forget(key)
+        with self.locked():
+            self.sync()
+            entry = self.index.pop(key, None)
+            if entry is None:
+                return
+            self.disk_used -= entry.size
+            try:
+                os.remove(self.path(key))
+            except OSError:   # already gone
+                pass
+            self.append({'op': 'remove', 'key': key})
+
+    def remember(self, key, data):
+        """
+        keep data in the memory tier, unless it alone is over the budget
+        """
+        if len(data) > self.memory_budget:
+            return
+        self.memory[key] = data
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_budget:
+            _, old = self.memory.popitem(last=False)
+            self.memory_used -= len(old)
+
+    def forget(self, key):
+        """
+        drop key from the memory tier only
+        """
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memory_used -= len(data)
+
+    def evict_disk(self):
+        """
+        remove the least recently used responses until the disk tier fits
+        its budget
+        """
+        while self.disk_used > self.disk_budget:
+            self.remove(next(iter(self.index)))
+
+
+class CacheWriter:
+    """
+    Stores one response while it is being received. The response is written
+    to a partial file in PARTIAL_DIR that replaces the old one, and becomes
+    visible to lookups, only on commit().
+    """
+    def __init__(self, cache, key):
+
+        self.cache = cache
+        self.key = key
+        self.partial = os.path.join(cache.directory, PARTIAL_DIR, '{}-{}'.format(os.getpid(), next(partial_ids)))
+        self.file = open(self.partial, 'wb', buffering=0)   # readable by followers as soon as written
+        self.size = 0
+        self.validators = None      # set by the caller once the head is known
+        # copy of the response for the memory tier, None once it is too large
+        self.chunks = []
+
+    def write(self, data):
+
+        self.file.write(data)
+        self.size += len(data)
+        if self.chunks is not None:
+            if self.size > MEMORY_OBJECT_LIMIT:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+
+    def commit(self):
+
+        self.file.close()
+        self.cache.add(self.key, self.partial, self.size, None if self.chunks is None else b''.join(self.chunks),
+                       self.validators)
+
+    def abort(self):
+        """
+        throw away what has been written, leaving the old response if any
+        """
+        self.file.close()
+        try:
+            os.remove(self.partial)
+        except OSError:
+            pass
@@ -0,0 +1,191 @@
+import io
+import bisect
+import random
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# fraction of the calls profiled when profiling is started without a rate
+PROFILE_RATE = 0.01
+# functions listed in a profile report
+PROFILE_LIMIT = 40
+
+# type and help text of every metric of the proxy
+METRICS = {
+    'proxy_requests_total': ('counter', 'Requests received from clients.'),
+    'proxy_request_seconds': ('histogram', 'Time to answer a client request.'),
+    'proxy_cache_requests_total': ('counter', 'Requests by how the cache answered them: hit, stale (expired, '
+                                              'sent while refreshed), coalesced (followed a fetch in progress), '
+                                              'expired or miss.'),
+    'proxy_revalidations_total': ('counter', 'Conditional requests for expired responses, by whether the web '
+                                             'server said they changed.'),
+    'proxy_sent_bytes_total': ('counter', 'Bytes of responses sent to clients, by where they came from.'),
+    'proxy_errors_total': ('counter', 'Error responses sent to clients, by status.'),
+    'proxy_origin_errors_total': ('counter', 'Fetches from web servers that failed.'),
+    'proxy_origin_connections_total': ('counter', 'Connections to web servers used, by whether they were '
+                                                  'reused from the pool.'),
+    'proxy_origin_connect_seconds': ('histogram', 'Time to get a connection to a web server, pooled or new.'),
+    'proxy_origin_first_byte_seconds': ('histogram', 'Time from asking for a connection to a web server to '
+                                                     'the head of its response.'),
+    'proxy_origin_response_seconds': ('histogram', 'Time from asking for a connection to a web server to the '
+                                                   'end of its response.'),
+    'proxy_client_connections': ('gauge', 'Open client connections.'),
+    'proxy_fetches_in_progress': ('gauge', 'Responses being fetched from web servers.'),
+    'proxy_origin_connections_idle': ('gauge', 'Connections to web servers waiting in the pool.'),
+    'proxy_cache_entries': ('gauge', 'Responses in the cache.'),
+    'proxy_cache_memory_bytes': ('gauge', 'Bytes of responses in the memory tier.'),
+    'proxy_cache_disk_bytes': ('gauge', 'Bytes of responses in the disk tier.'),
+}
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket of buckets, plus their sum
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of one proxy process, rendered
+    in the Prometheus text format. Counters have labels; a gauge is a
+    function read when the metrics are rendered. Every worker process keeps
+    its own, so each scrape shows the worker the kernel gave the connection
+    to.
+    """
+    def __init__(self):
+
+        # self.counters: (name, labels as sorted (name, value) pairs) -> value
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, function):
+
+        self.gauges[name] = function
+
+    def render(self):
+        """
+        the metrics in the Prometheus text exposition format
+        """
+        samples = {}    # name -> lines of its samples
+        for (name, labels), value in sorted(self.counters.items()):
+            samples.setdefault(name, []).append('{}{} {}'.format(name, format_labels(labels), value))
+        for name, histogram in sorted(self.histograms.items()):
+            lines = samples[name] = []
+            total = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, le, total))
+            lines.append('{}_sum {}'.format(name, histogram.sum))
+            lines.append('{}_count {}'.format(name, histogram.count))
+        for name, function in sorted(self.gauges.items()):
+            samples[name] = ['{} {}'.format(name, function())]
+        out = []
+        for name in sorted(samples):
+            kind, text = METRICS.get(name, ('untyped', ''))
+            out.append('# HELP {} {}'.format(name, text))
+            out.append('# TYPE {} {}'.format(name, kind))
+            out += samples[name]
+        return '\n'.join(out) + '\n'
+
+
+def format_labels(labels):
+
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Profiler:
+    """
+    Profiles a random fraction of the calls of the hot paths with cProfile,
+    switched on and off while the proxy runs. cProfile profiles the whole
+    thread while it is enabled, so the work of other tasks that run while a
+    sampled call waits is counted as well; the profile is enabled once,
+    however many sampled calls overlap.
+    """
+    def __init__(self):
+
+        self.rate = 0.0     # off
+        self.profile = cProfile.Profile()
+        self.active = 0     # sampled calls in progress
+
+    def start(self, rate=PROFILE_RATE):
+
+        self.rate = min(max(rate, 0.0), 1.0)
+
+    def stop(self):
+
+        self.rate = 0.0
+
+    def reset(self):
+        """
+        throw away what has been profiled so far
+        """
+        if self.active:
+            self.profile.disable()
+        self.profile = cProfile.Profile()
+        if self.active:
+            self.profile.enable()
+
+    @contextmanager
+    def sampled(self):
+        """
+        profile the block if it is sampled
+        """
+        if self.rate <= 0.0 or random.random() >= self.rate:
+            yield
+            return
+        if self.active == 0:
+            self.profile.enable()
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self.profile.disable()
+
+    def report(self, limit=PROFILE_LIMIT):
+        """
+        the limit functions with the most cumulative time, as text
+        """
+        out = io.StringIO()
+        out.write('sampling {:g} of the calls\n'.format(self.rate))
+        try:
+            pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(limit)
+        except TypeError:   # nothing profiled yet
+            out.write('no samples\n')
+        if self.active:   # reading the stats disabled the profile
+            self.profile.enable()
+        return out.getvalue()
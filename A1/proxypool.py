@@ -0,0 +1,106 @@
+import time
+import asyncio
+
+# default limits of the connections kept to each web server
+POOL_MAX_PER_HOST = 8       # connections in use at the same time
+POOL_IDLE_TIMEOUT = 30.0    # seconds an unused connection is kept open
+
+
+class OriginPool:
+    """
+    Keep-alive connections to web servers, per (host, port). A connection
+    given back after a complete response waits in the pool for the next
+    request to the same server, until it has been idle for idle_timeout
+    seconds. At most max_per_host connections to a server are in use at a
+    time; further requests wait for one of them.
+    """
+    def __init__(self, max_per_host=POOL_MAX_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT):
+
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # self.idle: (host, port) -> list of (reader, writer, idle since),
+        # most recently used last; self.limits: (host, port) -> Semaphore of
+        # the connections in use; self.busy: (host, port) -> how many
+        self.idle = {}
+        self.limits = {}
+        self.busy = {}
+
+    async def acquire(self, host, port):
+        """
+        return (reader, writer, reused) for a connection to host, taken from
+        the pool if there is a healthy one, or else newly opened
+        """
+        key = (host, port)
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = asyncio.Semaphore(self.max_per_host)
+            self.busy[key] = 0
+        await limit.acquire()
+        self.busy[key] += 1
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer, since = idle.pop()
+            if self.is_healthy(reader, writer, since):
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except BaseException:
+            self.done(key)
+            raise
+        return reader, writer, False
+
+    def release(self, host, port, reader, writer, reusable):
+        """
+        give back a connection from acquire(); it is kept for reuse if
+        reusable, that is if its last response was read completely and the
+        server did not ask to close it
+        """
+        key = (host, port)
+        if reusable and not writer.is_closing():
+            self.idle.setdefault(key, []).append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self.done(key)
+
+    def done(self, key):
+
+        self.busy[key] -= 1
+        self.limits[key].release()
+
+    def is_healthy(self, reader, writer, since):
+        """
+        whether an idle connection can be reused: not idle for too long and
+        not closed by the server
+        """
+        return time.monotonic() - since < self.idle_timeout and not writer.is_closing() \
+            and not reader.at_eof() and not reader.exception()
+
+    def reap(self):
+        """
+        close the connections idle for more than idle_timeout, and forget
+        the servers that have no connection left
+        """
+        for key in list(self.idle):
+            keep = []
+            for reader, writer, since in self.idle[key]:
+                if self.is_healthy(reader, writer, since):
+                    keep.append((reader, writer, since))
+                else:
+                    writer.close()
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+        for key in list(self.limits):
+            if self.busy[key] == 0 and key not in self.idle:
+                del self.limits[key]
+                del self.busy[key]
+
+    async def reap_forever(self):
+        """
+        reap() every idle_timeout / 2 seconds
+        """
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.reap()
@@ -0,0 +1,170 @@
+import sys, json, time, resource, argparse, itertools, tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import dvsim
+from dvsweep import parse_ints
+
+
+def run_case(case: dict) -> dict:
+    """
+    run one silent simulation and return case together with its results;
+    case has the keys num_nodes, topology, avg_degree, link_changes and seed,
+    plus the optional Simulator arguments vectorized, incremental,
+    poison_reverse, scenario, coalesce and profile. With trace_alloc, the
+    peak of the memory allocated by Python during the run is measured with
+    tracemalloc, which slows the run down.
+    Meant to run in a fresh process, so ru_maxrss is this case's peak memory.
+    """
+    if case.get("trace_alloc", False):
+        tracemalloc.start()
+    start = time.perf_counter()
+    sim = dvsim.Simulator(case["link_changes"], case["seed"], case["num_nodes"], case["topology"],
+                          avg_degree=case["avg_degree"],
+                          vectorized=case.get("vectorized", False),
+                          incremental=case.get("incremental", False),
+                          poison_reverse=case.get("poison_reverse", False),
+                          scenario=case.get("scenario"),
+                          coalesce=case.get("coalesce", False),
+                          profile=case.get("profile", False))
+    sim.run()
+    wall = time.perf_counter() - start
+
+    result = dict(case)
+    if tracemalloc.is_tracing():
+        result["alloc_peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    result["wall_time"] = wall
+    result["events"] = sim.total_events
+    result["events_per_sec"] = sim.total_events / wall
+    result["total_msgs"] = sim.total_msgs
+    result["convergence_time"] = sim.clocktime
+    result["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sim.timer:
+        result["phases"] = sim.timer.report()
+    return result
+
+
+def case_name(case: dict) -> str:
+
+    return "{topology}-n{num_nodes}-d{avg_degree:g}-l{link_changes}-s{seed}".format(**case)
+
+
+def run_suite(cases: list) -> list:
+    """
+    run every case one after the other, each in its own process
+    """
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results.append(pool.submit(run_case, case).result())
+    return results
+
+
+def instrumentation(result: dict) -> tuple:
+    """
+    the instrumentation a result was measured with, which slows the run
+    down: (profile, trace_alloc)
+    """
+    return result.get("profile", False), result.get("trace_alloc", False)
+
+
+def compare(results: list, baseline: list, tolerance: float, min_seconds: float=0.05) -> list:
+    """
+    compare results with a stored baseline and return a description of every
+    regression: a case or phase more than tolerance (a fraction) slower, a
+    traced allocation peak more than tolerance larger, or a case whose
+    message count or convergence time changed, which means the simulation
+    itself changed. Timings under min_seconds are too noisy to compare and
+    are skipped, as are the timings of cases measured with different
+    instrumentation than in the baseline.
+    """
+    previous = {case_name(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        name = case_name(r)
+        old = previous.get(name)
+        if old is None:
+            continue
+        if r["total_msgs"] != old["total_msgs"] or r["convergence_time"] != old["convergence_time"]:
+            regressions.append("{}: messages {} -> {}, convergence time {} -> {}".format(
+                name, old["total_msgs"], r["total_msgs"], old["convergence_time"], r["convergence_time"]))
+        if "alloc_peak_kib" in r and "alloc_peak_kib" in old and \
+                r["alloc_peak_kib"] > old["alloc_peak_kib"] * (1 + tolerance):
+            regressions.append("{}: allocation peak {} KiB -> {} KiB".format(
+                name, old["alloc_peak_kib"], r["alloc_peak_kib"]))
+        if instrumentation(r) != instrumentation(old):
+            continue
+        if old["wall_time"] >= min_seconds and r["wall_time"] > old["wall_time"] * (1 + tolerance):
+            regressions.append("{}: wall time {:.3f}s -> {:.3f}s".format(name, old["wall_time"], r["wall_time"]))
+        for phase, stats in r.get("phases", {}).items():
+            old_stats = old.get("phases", {}).get(phase)
+            if old_stats and old_stats["seconds"] >= min_seconds and \
+                    stats["seconds"] > old_stats["seconds"] * (1 + tolerance):
+                regressions.append("{}: {} {:.3f}s -> {:.3f}s".format(
+                    name, phase, old_stats["seconds"], stats["seconds"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dvsim over a matrix of topology sizes and densities")
+    parser.add_argument("--nodes", default="25,50,100", help='numbers of nodes, e.g. "25,50,100"')
+    parser.add_argument("--degrees", default="3,6", help="average degrees of the graphs")
+    parser.add_argument("--topology", default="erdos_renyi", help="topology name, see dvsim.TOPOLOGIES")
+    parser.add_argument("--link-changes", default="0,1", help='"0", "1" or "0,1"')
+    parser.add_argument("--seeds", default="1,2", help='e.g. "1,2"')
+    parser.add_argument("--vectorized", action="store_true", help="use ArrayNode")
+    parser.add_argument("--incremental", action="store_true", help="use incremental node updates")
+    parser.add_argument("--poison-reverse", action="store_true", help="use poisoned reverse")
+    parser.add_argument("--scenario", help="link-change scenario file, see dvsim.load_scenario")
+    parser.add_argument("--coalesce", action="store_true", help="coalesce simultaneous scenario changes")
+    parser.add_argument("--profile", action="store_true",
+                        help="time remove_next, update and to_link_layer (slows the run down)")
+    parser.add_argument("--trace-alloc", action="store_true",
+                        help="measure the allocation peak with tracemalloc (slows the run down)")
+    parser.add_argument("--save", help="write the results to this file, to use as a baseline")
+    parser.add_argument("--baseline", help="compare with results saved by --save, exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown (default 0.10)")
+    args = parser.parse_args()
+
+    cases = [{"num_nodes": n, "topology": args.topology, "avg_degree": d, "link_changes": l, "seed": seed,
+              "vectorized": args.vectorized, "incremental": args.incremental,
+              "poison_reverse": args.poison_reverse, "scenario": args.scenario, "coalesce": args.coalesce,
+              "profile": args.profile, "trace_alloc": args.trace_alloc}
+             for n, d, l, seed in itertools.product(parse_ints(args.nodes),
+                                                    [float(d) for d in args.degrees.split(",")],
+                                                    parse_ints(args.link_changes),
+                                                    parse_ints(args.seeds))]
+    results = run_suite(cases)
+
+    print("{:<30} {:>9} {:>10} {:>8} {:>9} {:>10} {:>9} {:>10}  {}".format(
+        "case", "messages", "events/s", "wall s", "peak MiB", "alloc KiB", "bytes/msg", "conv time",
+        "phases (s)"))
+    for r in results:
+        phases = " ".join("{}={:.3f}".format(p, s["seconds"]) for p, s in r.get("phases", {}).items())
+        if "alloc_peak_kib" in r:
+            per_msg = r["alloc_peak_kib"] * 1024 / max(r["total_msgs"], 1)
+            alloc = "{:>9} {:>9.1f}".format(r["alloc_peak_kib"], per_msg)
+        else:
+            alloc = "{:>9} {:>9}".format("-", "-")
+        print("{:<30} {:>9} {:>10.0f} {:>8.3f} {:>9.1f} {} {:>10.2f}  {}".format(
+            case_name(r), r["total_msgs"], r["events_per_sec"], r["wall_time"], r["peak_rss_kib"] / 1024,
+            alloc, r["convergence_time"], phases))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        previous = {case_name(r): r for r in baseline}
+        untimed = [case_name(r) for r in results
+                   if case_name(r) in previous and instrumentation(r) != instrumentation(previous[case_name(r)])]
+        if untimed:
+            print("timings not compared, --profile or --trace-alloc differs from the baseline:",
+                  ", ".join(untimed))
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against", args.baseline)
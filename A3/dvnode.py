@@ -1,40 +1,62 @@
 import copy
+from bisect import insort
 from math import inf
-from dvsim import Packet, NUM_NODES
+import dvsim
+
+try:
+    import numpy as np
+except ImportError:     # numpy is only needed by ArrayNode
+    np = None
 
 
 class Node:
     """
     a node in the network
     """
-    def __init__(self, nodeid: int, simulator):
+    def __init__(self, nodeid: int, simulator, incremental: bool=False, poison_reverse: bool=False):
         """
         Constructing a node in the network
+        incremental: recompute only the destinations whose entries changed in
+        a received vector, see update_incremental()
+        poison_reverse: advertise inf to a neighbour for every destination
+        reached through that neighbour, see send_pkt()
         """
         self.nodeid = nodeid        # nodeid is the node number
         self.simulator = simulator
+        self.num_nodes = len(self.simulator.cost[self.nodeid])  # the number of nodes in the network
+        self.incremental = incremental
+        self.poison_reverse = poison_reverse
+        # consistent is True while the own row and predecessors are exactly
+        # what a full update() would compute from dist_table; it is False
+        # until the first full update and after a link-cost change
+        self.consistent = False
         self.neighbours = self.find_neighbours()  # add node's neighbours to self.neighbours  
-        self.send_pkt(self.simulator.cost[self.nodeid]) # send packet to node's neighbours  
+        self.down_links = set()     # neighbours whose link failed (cost set to inf)
         # simulator is passed here so that the node can access 
         # - simulator.cost[nodeid] (only access the costs of this node's links) and
         # - simulator.to_link_layer() to send the message
         # You should not access anything else inside the simulator,
 
         # self.dist_table has the distance vectors as known by this node
-        # It is an NxN matrix where N is NUM_NODES.
+        # It is an NxN matrix where N is the number of nodes.
         # You need to make sure the dist_table is correctly updated throughout
         # the algorithm's execution.
         # Tip: although dist_table has N rows, each node might only access and
         # update a subset of the rows.
-        self.dist_table = [[inf for _ in range(NUM_NODES)] for _ in range(NUM_NODES)]  
+        # rows are only ever replaced, never modified in place, except this
+        # node's own row, so all the unknown rows share one tuple of inf
+        unknown = (inf,) * self.num_nodes
+        self.dist_table = [unknown] * self.num_nodes
         self.dist_table[self.nodeid] = self.simulator.cost[self.nodeid][:]  
   
         # self.predessor is a list of int  
         # self.predecessor keeps a list of the predecessor of this node in the  
         # path to each of the other nodes in the graph  
-        self.predecessors = [i for i in range(NUM_NODES)] # initialize self.predecessors list  
+        self.predecessors = [i for i in range(self.num_nodes)] # initialize self.predecessors list  
         self.predecessors[self.nodeid] = None  
 
+        self.send_pkt(self.simulator.cost[self.nodeid]) # send packet to node's neighbours  
+
     def get_link_cost(self, other):
         """
         Get the cost of the link between this node and other.
@@ -66,7 +88,9 @@ class Node:
         """
         neighbours = []
         cost_row = self.simulator.cost[self.nodeid]
-        for i in range(NUM_NODES):
+        if hasattr(cost_row, "neighbours"):     # sparse dvtopo.SparseRow
+            return cost_row.neighbours()
+        for i in range(self.num_nodes):
             if i != self.nodeid and cost_row[i] != inf:
                 neighbours.append(i)
         return neighbours
@@ -74,13 +98,56 @@ class Node:
     def send_pkt(self, vector):  
         """
         send packet to self node's neighbors 
+        with poison_reverse, the copy sent to neighbour i has inf for every
+        destination whose predecessor is i, so i never routes back through
+        this node (with whole-vector packets this is also what split horizon
+        comes down to)
+        """
+        vector = dvsim.snapshot(vector)     # shared by all the packets
+        routes_via = {}
+        if self.poison_reverse:
+            for dst, via in enumerate(self.predecessors):
+                if dst != self.nodeid and vector[dst] != inf:
+                    routes_via.setdefault(via, []).append(dst)
+        for i in self.neighbours:   # self.neighbours is kept in ascending order
+            poisoned = routes_via.get(i)
+            if poisoned:
+                v = list(vector)
+                for dst in poisoned:
+                    v[dst] = inf
+                p = dvsim.Packet(self.nodeid, i, v)
+            else:
+                p = dvsim.Packet(self.nodeid, i, vector)
+            self.simulator.to_link_layer(p)
+
+    def advertise(self):
+        """
+        send this node's distance vector to its neighbours
+        """
+        self.send_pkt(self.dist_table[self.nodeid])
+
+    def link_costs(self):
+        """
+        return (neighbour, cost of the link to it) for every neighbour, in the
+        order of self.neighbours
         """
-        for i in range(NUM_NODES):  
-            if i in self.neighbours:  
-                p = Packet(self.nodeid, i, vector)  
-                self.simulator.to_link_layer(p)  
+        return [(neighbor, self.get_link_cost(neighbor)) for neighbor in self.neighbours]
 
-    def update(self, pkt: Packet):
+    def relax(self, dst: int, link_costs):
+        """
+        recompute the shortest distance to dst over all neighbours, updating
+        self.predecessors[dst] to the first neighbour that achieves it
+        link_costs is the result of self.link_costs()
+        """
+        min_path_to_dst = inf
+        for neighbor, link_cost in link_costs:
+            new_path = link_cost + self.dist_table[neighbor][dst]
+            if new_path < min_path_to_dst: # if we find a new path smaller than the minimum path to destination node
+                min_path_to_dst = new_path
+                self.predecessors[dst] = neighbor
+        return min_path_to_dst
+
+    def update(self, pkt: 'dvsim.Packet'):
         """
         Handle updates when a packet is received. May need to call
         self.simulator.to_link_layer() with new packets based upon what after
@@ -88,40 +155,89 @@ class Node:
         packet correctly. Read dvsim.py for more details about the potential
         errors.
         """
+        if self.incremental and self.consistent:
+            self.update_incremental(pkt)
+            return
         # copy sender vector  
         self.dist_table[pkt.src] = pkt.dist_vector  
         self_vector = self.get_dist_vector()  
         old_vector = self_vector[:]  
+        link_costs = self.link_costs()  # read once, not once per destination
         for dst in range(len(self_vector)):  
             if dst != self.nodeid:  # recalculate distance vectors to other nodes expect itself  
-                min_path_to_dst = inf  
-                for neighbor in self.neighbours:  
-                    new_path = self.get_link_cost(neighbor) + self.dist_table[neighbor][dst]  
-                    if new_path < min_path_to_dst: # if we find a new path smaller than the minimum path to destination node  
-                        min_path_to_dst = new_path  
-                        self.predecessors[dst] = neighbor  
+                min_path_to_dst = self.relax(dst, link_costs)  
                 # printout statement for report  
                 # if min_path_to_dst < self_vector[dst]:  
                 #     print("Node " + str(self.nodeid) + " " + "original shortest path to Node " + str(dst) + " with distance " + str(self_vector[dst]))  
                 #     print("Node " + str(self.nodeid) + " " + "New shortest path to Node " + str(dst) + " with distance " + str(min_path_to_dst))  
   
                 self_vector[dst] = min_path_to_dst  # update the distance to destination node to new calculated minimum path  
+        self.consistent = True
         # if some vector value in self_vector changes, tell neighbours  
         if self_vector != old_vector:  
             self.send_pkt(self_vector) 
 
-    def link_cost_change_handler(self, which_link: int, new_cost: int):
+    def update_incremental(self, pkt: 'dvsim.Packet'):
+        """
+        Same result as update(), but only the destinations whose entry in the
+        sender's vector changed are looked at. For such a destination with
+        current best distance best through self.predecessors[dst]:
+        - if the sender is that next hop and its entry got worse, the old
+          best is gone and the destination is relaxed over all neighbours;
+        - otherwise the only candidate that moved is the path through the
+          sender, which wins if it is shorter, or equally short and the
+          sender comes first in self.neighbours (the tie-break of update()).
+        Only valid while self.consistent is True.
+        """
+        old_row = self.dist_table[pkt.src]
+        new_row = pkt.dist_vector
+        self.dist_table[pkt.src] = new_row
+        if pkt.src not in self.neighbours:  # link went down, row is unused
+            return
+        self_vector = self.get_dist_vector()
+        link_cost = self.get_link_cost(pkt.src)
+        changed = False
+        for dst in range(len(new_row)):
+            if new_row[dst] == old_row[dst] or dst == self.nodeid:
+                continue
+            best = self_vector[dst]
+            via = self.predecessors[dst]
+            if via == pkt.src and best != inf and new_row[dst] > old_row[dst]:
+                min_path_to_dst = self.relax(dst, self.link_costs())
+            else:
+                min_path_to_dst = link_cost + new_row[dst]
+                if min_path_to_dst < best or (min_path_to_dst == best != inf and
+                        self.neighbours.index(pkt.src) < self.neighbours.index(via)):
+                    self.predecessors[dst] = pkt.src
+                else:
+                    continue
+            if min_path_to_dst != best:
+                self_vector[dst] = min_path_to_dst
+                changed = True
+        if changed:
+            self.send_pkt(self_vector)
+
+    def link_cost_change_handler(self, which_link: int, new_cost: int, advertise: bool=True):
         """
         Handles the link-change event. The cost of the link between this node
         and which_link has been changed to new_cost. Need to update the
         information that is stored at this node, and notify the neighbours if
         necessary.
+        advertise: False when the simulator coalesces several changes and
+        calls advertise() once afterwards
         """
         if new_cost == inf: # handle edge case, when we set new_cost to inf, it means   
                             # which_link no longer connects with self node  
-            self.neighbours.remove(which_link)  
+            if which_link in self.neighbours:
+                self.neighbours.remove(which_link)  
+                self.down_links.add(which_link)
+        elif which_link not in self.neighbours:     # the failed link is back up, or a new link
+            self.down_links.discard(which_link)
+            insort(self.neighbours, which_link)
+        self.consistent = False     # own row is no longer a full update() result
         self.dist_table[self.nodeid][which_link] = new_cost # update dist_table to new_cost  
-        self.send_pkt(self.dist_table[self.nodeid]) # tell neighbors that new cost change  
+        if advertise:
+            self.advertise() # tell neighbors that new cost change  
 
     def print_dist_table(self):
         """
@@ -129,11 +245,91 @@ class Node:
         DO NOT MODIFY THIS METHOD
         """
         print(" D{}|".format(self.nodeid).rjust(5), end="")
-        for i in range(NUM_NODES):
+        for i in range(self.num_nodes):
             print("    {}".format(i), end="")
-        print("\n----+{}".format("-----"*NUM_NODES))
-        for i in range(NUM_NODES):
+        print("\n----+{}".format("-----"*self.num_nodes))
+        for i in range(self.num_nodes):
             print("{:4d}|".format(i), end="")
-            for j in range(NUM_NODES):
+            for j in range(self.num_nodes):
                 print(str(self.dist_table[i][j]).rjust(5), end="")
             print()
+
+
+class ArrayNode(Node):
+    """
+    a node that keeps dist_table and predecessors as NumPy arrays and does the
+    Bellman-Ford relaxation as one min/argmin over its neighbours' rows
+    """
+    def __init__(self, nodeid: int, simulator, incremental: bool=False, poison_reverse: bool=False):
+        """
+        Constructing an array-backed node in the network
+        """
+        if np is None:
+            raise RuntimeError("ArrayNode requires numpy")
+        super().__init__(nodeid, simulator, incremental, poison_reverse)
+        self.dist_table = np.array(self.dist_table, dtype=float)
+        # -1 marks the node itself, where the list-based node stores None
+        self.predecessors = np.array([-1 if p is None else p for p in self.predecessors])
+        self.load_link_costs()
+
+    def load_link_costs(self):
+        """
+        cache the neighbour ids and the cost of the link to each of them, in
+        the same order as self.neighbours
+        """
+        self.neighbour_ids = np.array(self.neighbours, dtype=int)
+        self.link_cost_vector = np.array([self.get_link_cost(n) for n in self.neighbours], dtype=float)
+
+    def get_predecessor(self, other: int) -> int:
+        """
+        Get the predecessor of this node in the path to other
+        """
+        p = int(self.predecessors[other])
+        return None if p < 0 else p
+
+    def update(self, pkt: 'dvsim.Packet'):
+        """
+        Same as Node.update, vectorized: row k of paths is the cost of
+        reaching every destination through the k-th neighbour. argmin returns
+        the first neighbour with the minimum, which matches the strict < of
+        the list-based loop, and destinations that stay unreachable keep
+        their old predecessor.
+        """
+        if self.incremental and self.consistent:
+            # only the columns that changed in the sender's row can move
+            dsts = np.flatnonzero(self.dist_table[pkt.src] != pkt.dist_vector)
+            dsts = dsts[dsts != self.nodeid]
+        else:
+            dsts = np.flatnonzero(np.arange(self.num_nodes) != self.nodeid)
+        self.dist_table[pkt.src] = pkt.dist_vector
+        self.consistent = True
+        if len(dsts) == 0:
+            return
+        if len(self.neighbour_ids) == 0:
+            new_vector = np.full(len(dsts), inf)
+        else:
+            paths = self.dist_table[np.ix_(self.neighbour_ids, dsts)] + self.link_cost_vector[:, None]
+            best = paths.argmin(axis=0)
+            new_vector = paths[best, np.arange(len(dsts))]
+            found = new_vector < inf
+            self.predecessors[dsts[found]] = self.neighbour_ids[best[found]]
+        self_vector = self.dist_table[self.nodeid]
+        if not np.array_equal(new_vector, self_vector[dsts]):
+            self_vector[dsts] = new_vector
+            self.send_pkt(self_vector.tolist())
+
+    def advertise(self):
+        """
+        send this node's distance vector to its neighbours
+        """
+        self.send_pkt(self.dist_table[self.nodeid].tolist())
+
+    def link_cost_change_handler(self, which_link: int, new_cost: int, advertise: bool=True):
+        """
+        Same as Node.link_cost_change_handler, also refreshing the cached
+        link costs
+        """
+        super().link_cost_change_handler(which_link, new_cost, advertise=False)
+        self.load_link_costs()
+        if advertise:
+            self.advertise()
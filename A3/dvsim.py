@@ -1,36 +1,58 @@
-import random, copy, sys
+import random, sys, heapq, json, time
 from math import inf
-from typing import List
+from typing import Sequence
 
 from dvnode import *
+import dvtopo
 
-# the number of nodes in the network
-# modify it when you test different graph sizes
+# the default number of nodes in the network, see Simulator(num_nodes=...)
 NUM_NODES = 3
 
 # event types
 EVT_FROM_LINK_LAYER = 0
 EVT_LINK_CHANGE = 1
 
+# the cost in a link-change scenario that brings a failed link back up with
+# the cost it had before it failed
+LINK_UP = "up"
+
+# topologies, by the name passed to Simulator(topology=...), and the method
+# that populates self.cost for each of them; "file:<path>" loads an edge list
+TOPOLOGIES = {
+    "manual": "generate_topology",
+    "random": "generate_random_topology",
+    "erdos_renyi": "generate_erdos_renyi_topology",
+    "waxman": "generate_waxman_topology",
+    "grid": "generate_grid_topology",
+    "fat_tree": "generate_fat_tree_topology",
+}
+
+# verbosity levels of the simulator's printouts
+VERBOSITY_SILENT = 0    # print nothing
+VERBOSITY_REPORT = 1    # print the final tables and shortest paths at the end of run()
+VERBOSITY_EVENTS = 2    # also print every event, packet and scheduled arrival time
+
 
 class Packet:
     """
     A packet is a message that is sent between neighbouring nodes, to tell the
     neighbour about their latest distance vector.
     """
+    __slots__ = ("src", "dest", "dist_vector")
 
     def __init__(self, src, dest, dist_vector):
 
         self.src = src      # the sender of the packet
         self.dest = dest    # the receiver of the packet
 
-        # self.dist_vector is a list of int
-        self.dist_vector = copy.deepcopy(dist_vector)
-        assert len(self.dist_vector) == NUM_NODES
+        # self.dist_vector is an immutable snapshot (a tuple) of the sender's
+        # vector; a tuple passed in is shared rather than copied, so a node
+        # sending to several neighbours snapshots its vector only once
+        self.dist_vector = snapshot(dist_vector)
 
     def copy(self):
         """
-        return a copy of the packet
+        return a copy of the packet, sharing its dist_vector snapshot
         """
         pkt = Packet(self.src, self.dest, self.dist_vector)
         return pkt
@@ -43,13 +65,23 @@ class Packet:
 
         return self.dest
 
-    def get_dist_vector(self) -> List[int]:
+    def get_dist_vector(self) -> Sequence[int]:
 
         return self.dist_vector
 
     def __str__(self):
 
-        return "src: {}, dest: {}, dist_vector: {}".format(self.src, self.dest, self.dist_vector)
+        return "src: {}, dest: {}, dist_vector: {}".format(self.src, self.dest, list(self.dist_vector))
+
+
+def snapshot(dist_vector) -> tuple:
+    """
+    return an immutable copy of dist_vector, or dist_vector itself if it
+    already is a tuple
+    """
+    if type(dist_vector) is tuple:
+        return dist_vector
+    return tuple(dist_vector)
 
 
 class Event:
@@ -58,14 +90,18 @@ class Event:
     - EVT_FROM_LINK_LAYER: a node receives a message from the link layer
     - EVT_LINK_CHANGE: a node's link's cost is changed
     """
-    def __init__(self, time: float, typ: int, node: int, pkt: Packet=None):
+    __slots__ = ("time", "type", "node", "packet", "change")
+
+    def __init__(self, time: float, typ: int, node: int, pkt: Packet=None, change: tuple=None):
 
         self.time = time    # time of the event
         self.type = typ     # EVT_FROM_LINK_LAYER or EVT_LINK_CHANGE
         self.node = node    # the node receiving the message (EVT_FROM_LINK_LAYER)
                             # node is irrelevant for EVT_LINK_CHANGE
-        if pkt:             # pkt is None for EVT_LINK_CHANGE
-            self.packet = pkt.copy()
+        self.packet = pkt   # pkt is None for EVT_LINK_CHANGE; packets are
+                            # never modified after sending, so it is not copied
+        self.change = change    # (node_a, node_b, new cost) of a scenario EVT_LINK_CHANGE,
+                                # None for the one made by generate_link_change()
 
     def get_time(self) -> float:
 
@@ -94,16 +130,39 @@ class EventList:
     """
     def __init__(self):
 
-        # data is a list of Event
+        # data is a binary heap of (time, seq, Event); seq is the insertion
+        # counter, so events with equal times leave in the order they were added
         self.data = list()
+        self.seq = 0
+
+        # last maps (src, dest) to [pending message count, latest arrival time]
+        # for the EVT_FROM_LINK_LAYER events still in the list
+        self.last = dict()
 
     def add(self, evt: Event):
         """
         add a new event to the event list
         """
-        self.data.append(evt)
+        heapq.heappush(self.data, (evt.get_time(), self.seq, evt))
+        self.seq += 1
+        if evt.get_type() == EVT_FROM_LINK_LAYER:
+            key = (evt.get_packet().get_src(), evt.get_node())
+            entry = self.last.get(key)
+            if entry is None:
+                self.last[key] = [1, evt.get_time()]
+            else:
+                entry[0] += 1
+                entry[1] = max(entry[1], evt.get_time())
         return
 
+    def peek(self) -> Event:
+        """
+        return the next event to take place without removing it
+        """
+        if len(self.data) == 0:
+            return None
+        return self.data[0][2]
+
     def remove_next(self) -> Event:
         """
         remove and return the event with the smallest time value,
@@ -111,63 +170,176 @@ class EventList:
         """
         if len(self.data) == 0:
             return None
-        smallest_time = inf
-        smallest_index = None
-        for i in range(len(self.data)):
-            if self.data[i].get_time() < smallest_time:
-                smallest_time = self.data[i].get_time()
-                smallest_index = i
-        return self.data.pop(smallest_index)
+        evt = heapq.heappop(self.data)[2]
+        if evt.get_type() == EVT_FROM_LINK_LAYER:
+            key = (evt.get_packet().get_src(), evt.get_node())
+            entry = self.last[key]
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self.last[key]
+        return evt
 
     def get_last_packet_time(self, from_node: int, to_node: int) -> float:
         """
         return the time of the last message from from_node to to_node
         return 0 if such message does not exist in the event list
+
+        to_link_layer() schedules each link's messages in increasing time
+        order, so the latest one is always the last to be removed and the
+        running maximum in self.last stays exact.
         """
-        rv = 0.0
-        for evt in self.data:
-            if evt.get_type() == EVT_FROM_LINK_LAYER and \
-                    evt.get_node() == to_node and \
-                    evt.get_packet().get_src() == from_node:
-                rv = max(rv, evt.get_time())
-        return rv
+        entry = self.last.get((from_node, to_node))
+        if entry is None:
+            return 0.0
+        return entry[1]
+
+
+def load_scenario(path: str) -> list:
+    """
+    read a link-change scenario: one "time node_a node_b cost" line per
+    change, where cost is a number, "down" (or "inf") for a link failure or
+    "up" to bring a failed link back with its previous cost. Blank lines and
+    lines starting with # are ignored. Returns a list of (time, a, b, cost).
+    """
+    changes = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) != 4:
+                raise RuntimeError("Bad scenario line: {}".format(line.strip()))
+            if fields[3] == LINK_UP:
+                cost = LINK_UP
+            elif fields[3] == "down":
+                cost = inf
+            else:
+                cost = float(fields[3])
+                if cost.is_integer():
+                    cost = int(cost)
+            changes.append((float(fields[0]), int(fields[1]), int(fields[2]), cost))
+    return changes
+
+
+class PhaseTimer:
+    """
+    Call counts and wall time of the simulator's hot paths, see
+    Simulator(profile=True). Times are inclusive: Node.update includes the
+    to_link_layer calls it makes.
+    """
+    def __init__(self):
+
+        # phase name -> [calls, seconds]
+        self.phases = dict()
+
+    def wrap(self, phase: str, func):
+        """
+        return func, timed under phase
+        """
+        totals = self.phases.setdefault(phase, [0, 0.0])
+        clock = time.perf_counter
+
+        def timed(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                totals[0] += 1
+                totals[1] += clock() - start
+        return timed
+
+    def report(self) -> dict:
+        """
+        return {phase: {"calls": ..., "seconds": ...}}
+        """
+        return {phase: {"calls": calls, "seconds": seconds} for phase, (calls, seconds) in self.phases.items()}
 
 
 class Simulator:
     """
     The simulator class
     """
-    def __init__(self, link_changes: int, seed: int):
+    def __init__(self, link_changes: int, seed: int, num_nodes: int=NUM_NODES,
+                 topology: str="manual", avg_degree: float=4.0, vectorized: bool=False,
+                 incremental: bool=False, poison_reverse: bool=False, scenario=None,
+                 coalesce: bool=False, verbosity: int=VERBOSITY_SILENT, trace=None,
+                 profile: bool=False):
         """
         link_changes (1 or 0): whether to include link-change event in the sim
         seed: seed for random number generator
+        num_nodes: the number of nodes in the network
+        topology: the name of the graph generator to use, a key of TOPOLOGIES,
+        or "file:<path>" to read the graph from an edge-list file
+        avg_degree: the average degree of the erdos_renyi and waxman graphs
+        vectorized: use the NumPy array-backed ArrayNode instead of Node
+        incremental: nodes only recompute destinations whose entries changed
+        poison_reverse: nodes advertise inf for routes back through the receiver
+        scenario: a file name for load_scenario(), or a list of
+        (time, node_a, node_b, cost) link changes, in addition to link_changes
+        coalesce: apply all the scenario changes that happen at the same time
+        together, so every node involved advertises its vector only once
+        verbosity: one of the VERBOSITY_* levels
+        trace: a file name or a text file to stream a JSONL trace of every
+        event and sent packet to, independent of verbosity (see write_trace)
+        profile: time EventList.remove_next, Node.update and to_link_layer,
+        the results are in self.timer
         """
+        self.verbosity = verbosity
+        self.trace = open(trace, "w") if isinstance(trace, str) else trace
+        self.trace_owned = isinstance(trace, str)   # close it at the end of run()
+        self.num_nodes = num_nodes
+        self.avg_degree = avg_degree
         self.cost = []
         self.total_msgs = 0
+        self.total_events = 0
         self.link_changes = link_changes
+        self.coalesce = coalesce
+        self.down_costs = dict()    # (a, b) with a < b -> cost before the link failed
         self.event_list = EventList()
+        self.timer = PhaseTimer() if profile else None
+        if profile:
+            # timed wrappers are only installed when profiling, so the
+            # normal run pays nothing for them
+            self.event_list.remove_next = self.timer.wrap("remove_next", self.event_list.remove_next)
+            self.to_link_layer = self.timer.wrap("to_link_layer", self.to_link_layer)
         random.seed(seed)
         self.clocktime = 0.0
 
-        # uncomment one of the following two lines to generate the graph,
-        # manually or randomly
+        # generate the graph, manually or randomly
         # this method will populate self.cost
-        self.generate_topology()
-        # self.generate_random_topology()
+        if topology.startswith("file:"):
+            self.cost = dvtopo.load_edge_list(topology[len("file:"):], self.num_nodes)
+        elif topology in TOPOLOGIES:
+            getattr(self, TOPOLOGIES[topology])()
+        else:
+            raise RuntimeError("Unknown topology: {}".format(topology))
+        if len(self.cost) != self.num_nodes:
+            raise RuntimeError("Topology has {} nodes, expected {}".format(len(self.cost), self.num_nodes))
 
         # creating the nodes of in the graph
         # calling the __init__ method of the Node class
-        self.nodes = [Node(x, self) for x in range(NUM_NODES)]
+        node_class = ArrayNode if vectorized else Node
+        self.nodes = [node_class(x, self, incremental, poison_reverse) for x in range(self.num_nodes)]
+        if profile:
+            for node in self.nodes:
+                node.update = self.timer.wrap("update", node.update)
 
         if link_changes:
             # modify the code the below to add more link-change events
             self.event_list.add(Event(10000.0, EVT_LINK_CHANGE, 0))
 
+        if isinstance(scenario, str):
+            scenario = load_scenario(scenario)
+        for t, a, b, cost in scenario or []:
+            if not (0 <= a < self.num_nodes and 0 <= b < self.num_nodes) or a == b:
+                raise RuntimeError("Illegal link in scenario: {} - {}".format(a, b))
+            self.event_list.add(Event(t, EVT_LINK_CHANGE, a, change=(a, b, cost)))
+
     def generate_topology(self):
         """
         This method manually defines a specific input graph.
         Modify this method to test different graphs
-        Make sure the size of this graph matches NUM_NODES
+        Make sure the size of this graph matches num_nodes
         """
         self.cost = [[0,   4,   50],
                      [4,   0,   1],
@@ -181,14 +353,40 @@ class Simulator:
 
     def generate_random_topology(self):
         """
-        This method generates a random topology with NUM_NODES nodes
+        This method generates a random topology with num_nodes nodes
         """
         choices = [1, 2, 3, 5, 7, 10, 15, 20, inf, inf]
-        self.cost = [[0 for _ in range(NUM_NODES)] for _ in range(NUM_NODES)]
-        for i in range(NUM_NODES):
-            for j in range(i+1, NUM_NODES):
+        self.cost = [[0 for _ in range(self.num_nodes)] for _ in range(self.num_nodes)]
+        for i in range(self.num_nodes):
+            for j in range(i+1, self.num_nodes):
                 self.cost[i][j] = self.cost[j][i] = random.choice(choices)
 
+    def generate_erdos_renyi_topology(self):
+        """
+        This method generates a sparse Erdos-Renyi graph with an average
+        degree of avg_degree
+        """
+        self.cost = dvtopo.erdos_renyi(self.num_nodes, self.avg_degree, random)
+
+    def generate_waxman_topology(self):
+        """
+        This method generates a sparse Waxman graph with an average degree of
+        about avg_degree
+        """
+        self.cost = dvtopo.waxman(self.num_nodes, self.avg_degree, random)
+
+    def generate_grid_topology(self):
+        """
+        This method generates a sparse 2D grid
+        """
+        self.cost = dvtopo.grid(self.num_nodes, random)
+
+    def generate_fat_tree_topology(self):
+        """
+        This method generates a k-ary fat tree, num_nodes must be the size of one
+        """
+        self.cost = dvtopo.fat_tree(self.num_nodes, random)
+
     def generate_link_change(self):
         """
         This method defines the link-change events that are added in __init__
@@ -207,39 +405,118 @@ class Simulator:
         self.nodes[nodeb].link_cost_change_handler(nodea, new_cost)
         return
 
+    def apply_link_change(self, nodea: int, nodeb: int, new_cost, advertise: bool=True):
+        """
+        apply one scenario link change, like generate_link_change() does;
+        new_cost may be inf (the link fails) or LINK_UP. Only existing or
+        failed links can be changed.
+        """
+        key = (min(nodea, nodeb), max(nodea, nodeb))
+        if new_cost == LINK_UP:
+            if key not in self.down_costs:
+                raise RuntimeError("Link {} - {} is not down".format(nodea, nodeb))
+            new_cost = self.down_costs.pop(key)
+        elif self.cost[nodea][nodeb] == inf:
+            if key not in self.down_costs:
+                raise RuntimeError("No link between {} and {}".format(nodea, nodeb))
+            if new_cost != inf:
+                del self.down_costs[key]
+        elif new_cost == inf:
+            self.down_costs[key] = self.cost[nodea][nodeb]
+
+        self.cost[nodea][nodeb] = new_cost
+        self.cost[nodeb][nodea] = new_cost
+        self.nodes[nodea].link_cost_change_handler(nodeb, new_cost, advertise)
+        self.nodes[nodeb].link_cost_change_handler(nodea, new_cost, advertise)
+
+    def apply_simultaneous_changes(self, evt: Event):
+        """
+        take every scenario change scheduled at the same time as evt off the
+        event list, apply them all, then let every node involved advertise
+        its vector once
+        """
+        changes = [evt.change]
+        while True:
+            following = self.event_list.peek()
+            if following is None or following.get_time() != evt.get_time() or \
+                    following.get_type() != EVT_LINK_CHANGE or following.change is None:
+                break
+            self.event_list.remove_next()
+            self.total_events += 1
+            self.log_event(following)
+            changes.append(following.change)
+
+        touched = []
+        for nodea, nodeb, new_cost in changes:
+            self.apply_link_change(nodea, nodeb, new_cost, advertise=False)
+            touched.extend(n for n in (nodea, nodeb) if n not in touched)
+        for n in touched:
+            self.nodes[n].advertise()
+
     def run(self):
         """
         Run the simulation
         """
         next = None
+        verbose = self.verbosity >= VERBOSITY_EVENTS
         while True:
 
             next = self.event_list.remove_next()
             if next is None:
                 break
-            print("\nmain(): event received. t={}, node={}".format(next.get_time(), next.get_node()))
-            if next.get_type() == EVT_FROM_LINK_LAYER:
-                p = next.get_packet()
-                print("\tsrc={}, dest={}, contents={}".format(p.get_src(), p.get_dest(), p.get_dist_vector()))
-            elif next.get_type() == EVT_LINK_CHANGE:
-                print("\tLink cost change.")
-            else:
-                raise RuntimeError("Panic: invalid type of event")
+            self.total_events += 1
+            if self.trace or verbose:
+                self.log_event(next)
 
             self.clocktime = next.get_time()
 
             if next.get_type() == EVT_FROM_LINK_LAYER:
                 p = next.get_packet()
-                if next.get_node() < 0 or next.get_node() >= NUM_NODES:
+                if next.get_node() < 0 or next.get_node() >= self.num_nodes:
                     raise RuntimeError("Panic: Unknown event node")
                 # the node receiving the packet calls its update() method
                 self.nodes[next.get_node()].update(p)
             elif next.get_type() == EVT_LINK_CHANGE:
                 # link-change event occurs
-                self.generate_link_change()
+                if next.change is None:
+                    self.generate_link_change()
+                elif self.coalesce:
+                    self.apply_simultaneous_changes(next)
+                else:
+                    self.apply_link_change(*next.change)
             else:
                 raise RuntimeError("Panic: Unknown event type")
 
+        if self.trace:
+            self.write_trace({"ev": "end", "t": self.clocktime, "msgs": self.total_msgs})
+            if self.trace_owned:
+                self.trace.close()
+            self.trace = None
+        if self.verbosity >= VERBOSITY_REPORT:
+            self.print_report()
+        return
+
+    def log_event(self, evt: Event):
+        """
+        trace and, at VERBOSITY_EVENTS, print an event taken off the event list
+        """
+        if self.trace:
+            self.trace_event(evt)
+        if self.verbosity >= VERBOSITY_EVENTS:
+            print("\nmain(): event received. t={}, node={}".format(evt.get_time(), evt.get_node()))
+            if evt.get_type() == EVT_FROM_LINK_LAYER:
+                p = evt.get_packet()
+                print("\tsrc={}, dest={}, contents={}".format(p.get_src(), p.get_dest(), list(p.get_dist_vector())))
+            elif evt.get_type() == EVT_LINK_CHANGE:
+                print("\tLink cost change.")
+            else:
+                raise RuntimeError("Panic: invalid type of event")
+
+    def print_report(self):
+        """
+        print the total number of messages, the distance table of every node
+        and the shortest path between every pair of nodes
+        """
         print("\nSimulator terminated at t={}, no packets in medium.".format(self.clocktime))
         print("Total number of messages:", self.total_msgs)
         print("\nFinal distance tables:")
@@ -248,8 +525,8 @@ class Simulator:
             node.print_dist_table()
 
         print("\nShortest paths:")
-        for i in range(NUM_NODES):
-            for j in range(i+1, NUM_NODES):
+        for i in range(self.num_nodes):
+            for j in range(i+1, self.num_nodes):
                 self.print_shortest_path(i, j)
         return
 
@@ -260,10 +537,10 @@ class Simulator:
         current_packet = None
         arrival_time = None
 
-        if pkt.get_src() < 0 or pkt.get_src() >= NUM_NODES:
+        if pkt.get_src() < 0 or pkt.get_src() >= self.num_nodes:
             raise RuntimeError("to_link_layer(): Illegal src id")
 
-        if pkt.get_dest() < 0 or pkt.get_dest() >= NUM_NODES:
+        if pkt.get_dest() < 0 or pkt.get_dest() >= self.num_nodes:
             raise RuntimeError("to_link_layer(): Illegal dest id")
 
         if pkt.get_src() == pkt.get_dest():
@@ -272,8 +549,12 @@ class Simulator:
         if self.cost[pkt.get_src()][pkt.get_dest()] == inf:
             raise RuntimeError("to_link_layer(): src and dest not connected")
 
-        print("to_link_layer(): src={}, dest={}, distance: {}".format(pkt.get_src(),
-                                                                      pkt.get_dest(), pkt.get_dist_vector()))
+        if len(pkt.get_dist_vector()) != self.num_nodes:
+            raise RuntimeError("to_link_layer(): dist_vector has the wrong size")
+
+        if self.verbosity >= VERBOSITY_EVENTS:
+            print("to_link_layer(): src={}, dest={}, distance: {}".format(pkt.get_src(),
+                                                                          pkt.get_dest(), list(pkt.get_dist_vector())))
 
         # Schedule the arrival time of this packet
         arrival_time = self.event_list.get_last_packet_time(pkt.get_src(), pkt.get_dest())
@@ -281,13 +562,40 @@ class Simulator:
             arrival_time = self.clocktime
         arrival_time += (1.0 + random.random() * 9.0)
 
-        print("to_link_layer(): scheduled arrival_time: {}".format(arrival_time))
-        current_packet = pkt.copy()
+        if self.verbosity >= VERBOSITY_EVENTS:
+            print("to_link_layer(): scheduled arrival_time: {}".format(arrival_time))
+        if self.trace:
+            self.write_trace({"ev": "send", "t": self.clocktime, "src": pkt.get_src(), "dest": pkt.get_dest(),
+                              "at": arrival_time, "dv": pkt.get_dist_vector()})
+        current_packet = pkt    # the sender hands the packet over, no copy needed
         self.event_list.add(Event(arrival_time, EVT_FROM_LINK_LAYER, current_packet.get_dest(), current_packet))
 
         self.total_msgs += 1
         return
 
+    def trace_event(self, evt: Event):
+        """
+        write the trace record of an event taken off the event list
+        """
+        if evt.get_type() == EVT_FROM_LINK_LAYER:
+            p = evt.get_packet()
+            self.write_trace({"ev": "recv", "t": evt.get_time(), "node": evt.get_node(),
+                              "src": p.get_src(), "dv": p.get_dist_vector()})
+        elif evt.change is None:
+            self.write_trace({"ev": "link", "t": evt.get_time()})
+        else:
+            a, b, cost = evt.change
+            self.write_trace({"ev": "link", "t": evt.get_time(), "a": a, "b": b, "cost": cost})
+
+    def write_trace(self, record: dict):
+        """
+        write one record to the trace as a line of compact JSON; ev is one of
+        "send", "recv", "link" or "end", t is the simulated time, and inf
+        distances are written as Infinity, which json.loads() reads back
+        """
+        self.trace.write(json.dumps(record, separators=(",", ":")))
+        self.trace.write("\n")
+
     def print_shortest_path(self, from_node, to_node):
         """
         print the shortest path from from_node to to_node
@@ -305,15 +613,18 @@ class Simulator:
 
 
 if __name__ == "__main__":
-    # if len(sys.argv) != 3:
-    #     print("Usage: python3 dvsim.py HasLinkChange Seed")
-    #     exit(0)
-    #
-    # has_link_change = int(sys.argv[1])
-    # seed = int(sys.argv[2])
-    #
-    # sim = Simulator(has_link_change, seed)
-    # sim.run()
-
-    sim = Simulator(1, 0)
+    if len(sys.argv) not in (1, 3, 5):
+        print("Usage: python3 dvsim.py [HasLinkChange Seed [NumNodes Topology]]")
+        exit(0)
+
+    has_link_change, seed = 1, 0
+    num_nodes, topology = NUM_NODES, "manual"
+    if len(sys.argv) >= 3:
+        has_link_change = int(sys.argv[1])
+        seed = int(sys.argv[2])
+    if len(sys.argv) == 5:
+        num_nodes = int(sys.argv[3])
+        topology = sys.argv[4]
+
+    sim = Simulator(has_link_change, seed, num_nodes, topology, verbosity=VERBOSITY_EVENTS)
     sim.run()
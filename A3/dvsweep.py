@@ -0,0 +1,116 @@
+import json, time, argparse, itertools
+from math import inf
+from concurrent.futures import ProcessPoolExecutor
+
+import dvsim
+
+
+def parse_ints(text: str):
+    """
+    parse a list of ints such as "3", "1,2,5" or "0-99" (inclusive ranges
+    can be mixed with single values: "0-9,20")
+    """
+    values = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            values.extend(range(int(first), int(last) + 1))
+        else:
+            values.append(int(part))
+    return values
+
+
+def run_one(config: dict) -> dict:
+    """
+    run one silent simulation and return config together with its results;
+    config has the keys seed, num_nodes, topology, avg_degree and
+    link_changes, plus the optional Simulator arguments vectorized,
+    incremental, poison_reverse, scenario and coalesce. Unreachable
+    destinations are None in dist_tables, so the results stay valid JSON
+    """
+    start = time.perf_counter()
+    sim = dvsim.Simulator(config["link_changes"], config["seed"], config["num_nodes"], config["topology"],
+                          avg_degree=config["avg_degree"],
+                          vectorized=config.get("vectorized", False),
+                          incremental=config.get("incremental", False),
+                          poison_reverse=config.get("poison_reverse", False),
+                          scenario=config.get("scenario"),
+                          coalesce=config.get("coalesce", False))
+    sim.run()
+    wall = time.perf_counter() - start
+
+    result = dict(config)
+    result["total_msgs"] = sim.total_msgs
+    result["convergence_time"] = sim.clocktime
+    result["wall_time"] = wall
+    result["dist_tables"] = [[None if d == inf else float(d) for d in node.get_dist_vector()]
+                             for node in sim.nodes]
+    result["predecessors"] = [[node.get_predecessor(d) for d in range(sim.num_nodes)] for node in sim.nodes]
+    return result
+
+
+def summarize(results: list) -> list:
+    """
+    aggregate total_msgs and convergence_time over the seeds of every
+    (num_nodes, topology, avg_degree, link_changes) combination
+    """
+    groups = {}
+    for r in results:
+        groups.setdefault((r["num_nodes"], r["topology"], r["avg_degree"], r["link_changes"]), []).append(r)
+    summary = []
+    for (num_nodes, topology, avg_degree, link_changes), runs in groups.items():
+        msgs = [r["total_msgs"] for r in runs]
+        times = [r["convergence_time"] for r in runs]
+        summary.append({"num_nodes": num_nodes, "topology": topology, "avg_degree": avg_degree,
+                        "link_changes": link_changes, "runs": len(runs),
+                        "total_msgs_mean": sum(msgs) / len(msgs), "total_msgs_min": min(msgs),
+                        "total_msgs_max": max(msgs),
+                        "convergence_time_mean": sum(times) / len(times),
+                        "convergence_time_max": max(times)})
+    return summary
+
+
+def sweep(configs: list, workers: int=None) -> dict:
+    """
+    run every config across a pool of worker processes, in config order
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_one, configs))
+    return {"runs": results, "summary": summarize(results)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run dvsim over every combination of the given parameters")
+    parser.add_argument("--seeds", default="0", help='e.g. "0-99" or "1,2,5"')
+    parser.add_argument("--nodes", default=str(dvsim.NUM_NODES), help='numbers of nodes, e.g. "10,20,50"')
+    parser.add_argument("--topologies", default="random",
+                        help="comma-separated names from: " + ", ".join(dvsim.TOPOLOGIES))
+    parser.add_argument("--degrees", default="4",
+                        help='average degrees of the erdos_renyi and waxman graphs, e.g. "3,6" (default 4)')
+    parser.add_argument("--link-changes", default="0", help='"0", "1" or "0,1"')
+    parser.add_argument("--vectorized", action="store_true", help="use ArrayNode")
+    parser.add_argument("--incremental", action="store_true", help="use incremental node updates")
+    parser.add_argument("--poison-reverse", action="store_true", help="use poisoned reverse")
+    parser.add_argument("--scenario", help="link-change scenario file, see dvsim.load_scenario")
+    parser.add_argument("--coalesce", action="store_true", help="coalesce simultaneous scenario changes")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--out", default="sweep.json", help="aggregated results file")
+    args = parser.parse_args()
+
+    degrees = [float(d) for d in args.degrees.split(",")]
+    configs = [{"seed": seed, "num_nodes": n, "topology": topology, "avg_degree": d,
+                "link_changes": link_changes, "vectorized": args.vectorized, "incremental": args.incremental,
+                "poison_reverse": args.poison_reverse, "scenario": args.scenario, "coalesce": args.coalesce}
+               for n, topology, d, link_changes, seed in itertools.product(parse_ints(args.nodes),
+                                                                           args.topologies.split(","),
+                                                                           degrees,
+                                                                           parse_ints(args.link_changes),
+                                                                           parse_ints(args.seeds))]
+    start = time.perf_counter()
+    results = sweep(configs, args.workers)
+    with open(args.out, "w") as f:
+        json.dump(results, f)
+    print("{} runs in {:.2f}s, results written to {}".format(len(configs), time.perf_counter() - start, args.out))
+    for s in results["summary"]:
+        print("nodes={num_nodes} topology={topology} degree={avg_degree:g} link_changes={link_changes} "
+              "runs={runs} msgs={total_msgs_mean:.1f} convergence_time={convergence_time_mean:.2f}".format(**s))
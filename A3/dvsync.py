@@ -0,0 +1,376 @@
+import sys, json, time, heapq, random, argparse
+from math import inf
+
+import dvsim
+import dvtopo
+
+try:
+    import numpy as np
+except ImportError:     # numpy is only needed by SyncSimulator
+    np = None
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+except ImportError:     # the oracle falls back to dijkstra() below
+    csgraph_dijkstra = None
+
+# elements of the (links x destinations) arrays of one block of
+# destinations; the block size is picked so they stay about this large
+BLOCK_ELEMENTS = 1 << 22
+# mismatches listed by cross_check(), the others are only counted
+MAX_MISMATCHES = 20
+
+
+def make_cost(num_nodes: int, topology: str, seed: int, avg_degree: float=4.0):
+    """
+    return the cost matrix dvsim.Simulator(..., seed, num_nodes, topology,
+    avg_degree=avg_degree) starts with, without creating its nodes, so
+    graphs too large for the event-driven simulator can be built
+    """
+    random.seed(seed)
+    if topology.startswith("file:"):
+        return dvtopo.load_edge_list(topology[len("file:"):], num_nodes)
+    if topology not in dvsim.TOPOLOGIES:
+        raise RuntimeError("Unknown topology: {}".format(topology))
+    shell = dvsim.Simulator.__new__(dvsim.Simulator)    # only the generator's inputs
+    shell.num_nodes = num_nodes
+    shell.avg_degree = avg_degree
+    getattr(shell, dvsim.TOPOLOGIES[topology])()
+    return shell.cost
+
+
+def csr_arrays(cost):
+    """
+    return (indptr, indices, weights) NumPy arrays of the links of cost with
+    a finite cost, a dvtopo.SparseCost or a dense list of lists; the
+    neighbours of every node are in ascending order, like Node.neighbours
+    """
+    num_nodes = len(cost)
+    if isinstance(cost, dvtopo.SparseCost):
+        indptr = np.array(cost.indptr, dtype=np.int64)
+        indices = np.array(cost.indices, dtype=np.int64)
+        weights = np.array(cost.weights, dtype=float)
+        rows = np.repeat(np.arange(num_nodes), np.diff(indptr))
+    else:
+        links = [(i, j, c) for i in range(num_nodes) for j, c in enumerate(cost[i]) if j != i and c != inf]
+        rows = np.array([i for i, _, _ in links], dtype=np.int64)
+        indices = np.array([j for _, j, _ in links], dtype=np.int64)
+        weights = np.array([c for _, _, c in links], dtype=float)
+    up = weights != inf    # failed links are not used by the nodes
+    rows, indices, weights = rows[up], indices[up], weights[up]
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    return indptr, indices, weights
+
+
+def dijkstra(indptr: list, indices: list, weights: list, source: int) -> list:
+    """
+    return the distances from source to every node over CSR lists
+    """
+    dist = [inf] * (len(indptr) - 1)
+    dist[source] = 0
+    heap = [(0, source)]
+    while heap:
+        d, v = heapq.heappop(heap)
+        if d > dist[v]:
+            continue
+        for k in range(indptr[v], indptr[v + 1]):
+            w = indices[k]
+            nd = d + weights[k]
+            if nd < dist[w]:
+                dist[w] = nd
+                heapq.heappush(heap, (nd, w))
+    return dist
+
+
+class SyncSimulator:
+    """
+    Runs the distance-vector computation of dvsim as synchronous rounds
+    instead of events: in every round each node receives the vectors its
+    neighbours sent in the previous round and recomputes its own, and
+    sends it to all its neighbours if it changed, as Node.update() does.
+    A round is the min-plus product of the link costs (CSR arrays) with the
+    distance table. Distances only go down from the initial link costs, so
+    the product only needs the entries that changed in the previous round:
+    each is added to the cost of every link of its node and the minimum is
+    kept with np.minimum.at. The predecessors are found once at the end,
+    with np.minimum.reduceat over every node's links.
+
+    Each destination's column evolves independently of the others, so the
+    table is computed one block of columns at a time, which bounds the
+    memory needed. The costs are taken as they are, so the result is the
+    state the event-driven simulator converges to after its last link
+    change: the shortest distances, and for predecessors the first
+    neighbour in ascending order that achieves them.
+    """
+    def __init__(self, cost, block_size: int=None):
+        """
+        cost: the cost matrix, as in Simulator.cost
+        block_size: destinations computed together, by default as many as
+        fit in BLOCK_ELEMENTS
+        """
+        if np is None:
+            raise RuntimeError("SyncSimulator requires numpy")
+        self.num_nodes = len(cost)
+        self.indptr, self.indices, self.weights = csr_arrays(cost)
+        self.degree = np.diff(self.indptr)
+        self.block_size = block_size or max(1, BLOCK_ELEMENTS // max(len(self.indices), self.num_nodes, 1))
+        self.csr_lists = None   # the CSR arrays as lists, for dijkstra()
+
+        # self.round_msgs[r] is the number of messages sent in round r, round
+        # 0 being every node sending its link costs; the network is quiet
+        # after self.rounds = len(self.round_msgs) rounds
+        self.round_msgs = []
+        self.total_msgs = 0
+        self.rounds = 0
+        # filled by run(store=True): dist_table[i] is node i's distance
+        # vector, predecessors[i][d] its next hop to d, -1 for d == i
+        self.dist_table = None
+        self.predecessors = None
+
+    def entries(self, rows):
+        """
+        return the positions in self.indices of the links of rows, a
+        non-empty array in which nodes may repeat, and where the links of
+        each row start in that list
+        """
+        counts = self.degree[rows]
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        return np.arange(ends[-1]) + np.repeat(self.indptr[rows] - starts, counts), starts
+
+    def initial_block(self, first: int, end: int):
+        """
+        the columns first to end - 1 of the nodes' own rows before any
+        message: the link costs
+        """
+        dist = np.full((self.num_nodes, end - first), inf)
+        rows = np.repeat(np.arange(self.num_nodes), self.degree)
+        inside = (self.indices >= first) & (self.indices < end)
+        dist[rows[inside], self.indices[inside] - first] = self.weights[inside]
+        dist[np.arange(first, end), np.arange(end - first)] = 0
+        return dist
+
+    def block_predecessors(self, first: int, end: int, dist):
+        """
+        the predecessors of the converged columns dist: for a reachable
+        destination, the first neighbour whose path achieves the distance;
+        otherwise the destination itself, which is what Node starts with
+        """
+        preds = np.tile(np.arange(first, end), (self.num_nodes, 1))
+        rows = np.flatnonzero(self.degree > 0)
+        if rows.size:
+            offsets, starts = self.entries(rows)
+            paths = dist[self.indices[offsets]] + self.weights[offsets, None]
+            best = np.repeat(dist[rows], self.degree[rows], axis=0)
+            none = len(self.indices)
+            pos = np.where((paths == best) & (best != inf), offsets[:, None], none)
+            first_pos = np.minimum.reduceat(pos, starts, axis=0)
+            found = first_pos < none
+            row_preds = preds[rows]
+            row_preds[found] = self.indices[first_pos[found]]
+            preds[rows] = row_preds
+        preds[np.arange(first, end), np.arange(end - first)] = -1
+        return preds
+
+    def blocks(self):
+        """
+        run the rounds one block of destinations at a time, yielding
+        (first, end, dist, preds) with the converged columns first to end - 1
+        of every node's distance vector and predecessors; the message counts
+        are set once the last block is done
+        """
+        n = self.num_nodes
+        # sent[r]: which nodes sent their vector in round r, in any block
+        sent = [self.degree > 0]
+        for first in range(0, n, self.block_size):
+            end = min(n, first + self.block_size)
+            width = end - first
+            dist = self.initial_block(first, end)
+            flat = dist.reshape(-1)
+            # entries of dist (as positions in flat) that changed in the last
+            # round; in round 0 the nodes sent all they knew
+            changed = np.flatnonzero(flat != inf)
+            mark = np.zeros(flat.size, dtype=bool)
+            r = 0
+            while changed.size:
+                rows = changed // width
+                offsets, _ = self.entries(rows)
+                counts = self.degree[rows]
+                targets = self.indices[offsets] * width + np.repeat(changed - rows * width, counts)
+                paths = np.repeat(flat[changed], counts) + self.weights[offsets]
+                better = paths < flat[targets]
+                targets = targets[better]
+                np.minimum.at(flat, targets, paths[better])     # paths were read before any update
+                mark[targets] = True
+                changed = np.flatnonzero(mark)
+                mark[changed] = False
+                if changed.size == 0:
+                    break
+                r += 1
+                if r == len(sent):
+                    sent.append(np.zeros(n, dtype=bool))
+                sent[r][changed // width] = True
+            yield first, end, dist, self.block_predecessors(first, end, dist)
+        self.round_msgs = [int(self.degree[s].sum()) for s in sent]
+        self.total_msgs = sum(self.round_msgs)
+        self.rounds = len(self.round_msgs)
+
+    def run(self, store: bool=True, on_block=None):
+        """
+        run the rounds until no node changes; with store, keep the final
+        dist_table and predecessors of every node (num_nodes^2 entries each),
+        and call on_block with every result of blocks(), if given
+        """
+        n = self.num_nodes
+        if store:
+            self.dist_table = np.empty((n, n))
+            self.predecessors = np.empty((n, n), dtype=np.int32 if n < 2 ** 31 else np.int64)
+        for first, end, dist, preds in self.blocks():
+            if store:
+                self.dist_table[:, first:end] = dist
+                self.predecessors[:, first:end] = preds
+            if on_block is not None:
+                on_block(first, end, dist, preds)
+
+    def get_predecessor(self, node: int, other: int) -> int:
+        """
+        the predecessor of node in the path to other, after run()
+        """
+        p = int(self.predecessors[node, other])
+        return None if p < 0 else p
+
+    def oracle(self, sources):
+        """
+        return the all-pairs shortest-path distances from every node of
+        sources, one row each, with scipy's Dijkstra if available
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        if csgraph_dijkstra is not None:
+            graph = csr_matrix((self.weights, self.indices, self.indptr), shape=(self.num_nodes, self.num_nodes))
+            return csgraph_dijkstra(graph, indices=sources)
+        if self.csr_lists is None:
+            self.csr_lists = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist())
+        return np.array([dijkstra(*self.csr_lists, s) for s in sources.tolist()], dtype=float).reshape(-1, self.num_nodes)
+
+
+def simulator_block(sim, first: int, end: int):
+    """
+    the columns first to end - 1 of the distance vectors and predecessors
+    (-1 for the node itself) of the nodes of sim
+    """
+    dist = np.array([node.get_dist_vector()[first:end] for node in sim.nodes], dtype=float)
+    preds = np.array([[-1 if p is None else p for p in node.predecessors[first:end]] for node in sim.nodes])
+    return dist, preds.reshape(len(sim.nodes), end - first)
+
+
+def describe(what: str, dist, other, where, first: int, other_name: str) -> list:
+    """
+    describe the entries of where, of the block starting at first, where
+    dist and other differ
+    """
+    return ["node {} -> {}: {} {} (sync) vs {} ({})".format(i, first + k, what, dist[i, k], other[i, k], other_name)
+            for i, k in zip(*np.nonzero(where))]
+
+
+def cross_check(engine: SyncSimulator, sim=None, oracle: bool=False, oracle_sample: int=None,
+                seed: int=0, store: bool=False) -> list:
+    """
+    run engine and compare every block of its final state with that of sim,
+    an event-driven dvsim.Simulator that has run on the same cost matrix
+    (predecessors only where the destination is reachable), and with the
+    all-pairs shortest paths if oracle; oracle_sample limits the oracle to
+    that many random destinations. Return a description of every mismatch,
+    at most MAX_MISMATCHES and then how many more there are. store is
+    passed on to engine.run()
+    """
+    mismatches = []
+    count = 0
+    checked = None
+    if oracle and oracle_sample is not None and oracle_sample < engine.num_nodes:
+        checked = np.zeros(engine.num_nodes, dtype=bool)
+        checked[random.Random(seed).sample(range(engine.num_nodes), oracle_sample)] = True
+
+    def report(found):
+        nonlocal count
+        count += len(found)
+        mismatches.extend(found[:MAX_MISMATCHES - len(mismatches)])
+
+    def check_block(first, end, dist, preds):
+        if sim is not None:
+            sim_dist, sim_preds = simulator_block(sim, first, end)
+            report(describe("distance", dist, sim_dist, dist != sim_dist, first, "simulator"))
+            report(describe("predecessor", preds, sim_preds, (preds != sim_preds) & (dist != inf), first,
+                            "simulator"))
+        if oracle:
+            columns = np.arange(first, end) if checked is None else np.flatnonzero(checked[first:end]) + first
+            if columns.size:
+                # the graph is undirected, so the column of d is the row from d
+                expected = engine.oracle(columns).T
+                got = dist[:, columns - first]
+                wrong = ~np.isclose(got, expected, rtol=1e-9, atol=0) & (got != expected)
+                for i, k in zip(*np.nonzero(wrong)):
+                    report(["node {} -> {}: distance {} (sync) vs {} (shortest path)".format(
+                        i, columns[k], got[i, k], expected[i, k])])
+
+    engine.run(store, check_block)
+    if count > len(mismatches):
+        mismatches.append("... and {} more".format(count - len(mismatches)))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run dvsim's distance-vector computation as synchronous rounds")
+    parser.add_argument("--nodes", type=int, default=dvsim.NUM_NODES, help="number of nodes")
+    parser.add_argument("--topology", default="erdos_renyi", help="topology name, see dvsim.TOPOLOGIES")
+    parser.add_argument("--avg-degree", type=float, default=4.0, help="average degree (default 4)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the topology (default 0)")
+    parser.add_argument("--block-size", type=int, default=None, help="destinations computed together")
+    parser.add_argument("--check-sim", action="store_true",
+                        help="also run the event-driven simulator and compare its final state")
+    parser.add_argument("--oracle", action="store_true", help="compare with all-pairs shortest paths")
+    parser.add_argument("--oracle-sample", type=int, default=None,
+                        help="only compare this many random destinations with the oracle")
+    parser.add_argument("--link-changes", type=int, default=0, help="with --check-sim, as in dvsim (default 0)")
+    parser.add_argument("--scenario", help="with --check-sim, link-change scenario file, see dvsim.load_scenario")
+    parser.add_argument("--vectorized", action="store_true", help="with --check-sim, use ArrayNode")
+    parser.add_argument("--incremental", action="store_true", help="with --check-sim, use incremental updates")
+    parser.add_argument("--out", help="write the round message counts to this file")
+    parser.add_argument("--tables", action="store_true", help="also write every node's final table to --out")
+    args = parser.parse_args()
+
+    sim = None
+    if args.check_sim:
+        start = time.perf_counter()
+        sim = dvsim.Simulator(args.link_changes, args.seed, args.nodes, args.topology, avg_degree=args.avg_degree,
+                              vectorized=args.vectorized, incremental=args.incremental, scenario=args.scenario)
+        sim.run()
+        print("event simulator: {} messages, converged at t={:.2f}, {:.3f}s".format(
+            sim.total_msgs, sim.clocktime, time.perf_counter() - start))
+        cost = sim.cost     # the final costs, after the link changes
+    else:
+        cost = make_cost(args.nodes, args.topology, args.seed, args.avg_degree)
+
+    start = time.perf_counter()
+    engine = SyncSimulator(cost, args.block_size)
+    mismatches = cross_check(engine, sim, args.oracle, args.oracle_sample, args.seed, store=args.tables)
+    print("synchronous: {} rounds, {} messages, {:.3f}s".format(engine.rounds, engine.total_msgs,
+                                                               time.perf_counter() - start))
+    print("messages per round:", ",".join(str(m) for m in engine.round_msgs))
+
+    if args.out:
+        result = {"num_nodes": args.nodes, "topology": args.topology, "avg_degree": args.avg_degree,
+                  "seed": args.seed, "rounds": engine.rounds, "round_msgs": engine.round_msgs,
+                  "total_msgs": engine.total_msgs}
+        if args.tables:
+            result["dist_tables"] = engine.dist_table.tolist()
+            result["predecessors"] = [[None if p < 0 else p for p in row] for row in engine.predecessors.tolist()]
+        with open(args.out, "w") as f:
+            json.dump(result, f)
+    if args.check_sim or args.oracle:
+        for line in mismatches:
+            print("MISMATCH", line)
+        if mismatches:
+            sys.exit(1)
+        print("final state matches")
@@ -0,0 +1,285 @@
+import math
+from array import array
+from bisect import bisect_left
+from math import inf
+
+# the link costs drawn by the random generators, same as
+# Simulator.generate_random_topology() without the inf entries
+COST_CHOICES = [1, 2, 3, 5, 7, 10, 15, 20]
+
+
+class SparseCost:
+    """
+    A symmetric cost matrix stored as CSR arrays, for graphs too large for the
+    dense list of lists. The neighbours of node i are
+    indices[indptr[i]:indptr[i+1]], in ascending order, and weights holds the
+    matching link costs. cost[i] is a SparseRow, so cost[i][j], cost[i][j] = c
+    and cost[i][:] work like they do on the dense matrix.
+    """
+    def __init__(self, num_nodes: int, edges):
+        """
+        edges: an iterable of (a, b, cost) undirected links
+        """
+        self.num_nodes = num_nodes
+        edges = list(edges)
+
+        degree = [0] * (num_nodes + 1)
+        for a, b, c in edges:
+            if a == b or not (0 <= a < num_nodes and 0 <= b < num_nodes):
+                raise RuntimeError("Illegal link: {} - {}".format(a, b))
+            degree[a + 1] += 1
+            degree[b + 1] += 1
+        for i in range(num_nodes):
+            degree[i + 1] += degree[i]
+
+        # self.indptr, self.indices: CSR structure, self.weights: link costs
+        # weights is a plain list so integer costs stay ints and a link can
+        # be set to inf
+        self.indptr = array("l", degree)
+        self.indices = array("l", bytes(self.indptr.itemsize * degree[-1]))
+        self.weights = [0] * degree[-1]
+        fill = degree[:-1]
+        for a, b, c in edges:
+            for u, v in ((a, b), (b, a)):
+                self.indices[fill[u]] = v
+                self.weights[fill[u]] = c
+                fill[u] += 1
+
+        for i in range(num_nodes):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            row = sorted(zip(self.indices[start:end], self.weights[start:end]))
+            for k in range(1, len(row)):
+                if row[k][0] == row[k - 1][0]:
+                    raise RuntimeError("Duplicate link: {} - {}".format(i, row[k][0]))
+            for k, (v, c) in enumerate(row):
+                self.indices[start + k] = v
+                self.weights[start + k] = c
+
+        self.rows = [SparseRow(self, i) for i in range(num_nodes)]
+
+    def __len__(self):
+
+        return self.num_nodes
+
+    def __getitem__(self, i: int) -> "SparseRow":
+
+        return self.rows[i]
+
+    def find(self, i: int, j: int) -> int:
+        """
+        return the position of link i - j in self.indices, or -1
+        """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        k = bisect_left(self.indices, j, start, end)
+        if k < end and self.indices[k] == j:
+            return k
+        return -1
+
+    def insert(self, i: int, j: int, cost):
+        """
+        add the one-way entry i -> j; O(N + M), meant for the occasional
+        link-change event
+        """
+        k = bisect_left(self.indices, j, self.indptr[i], self.indptr[i + 1])
+        self.indices.insert(k, j)
+        self.weights.insert(k, cost)
+        for r in range(i + 1, self.num_nodes + 1):
+            self.indptr[r] += 1
+
+    def num_links(self) -> int:
+
+        return len(self.indices) // 2
+
+
+class SparseRow:
+    """
+    The costs of the links of one node of a SparseCost
+    """
+    __slots__ = ("matrix", "node")
+
+    def __init__(self, matrix: SparseCost, node: int):
+
+        self.matrix = matrix
+        self.node = node
+
+    def __len__(self):
+
+        return self.matrix.num_nodes
+
+    def __getitem__(self, other):
+        """
+        cost of the link to other (0 to itself, inf if there is no link);
+        a slice returns the matching part of the dense row as a list
+        """
+        if isinstance(other, slice):
+            return self.dense()[other]
+        if other == self.node:
+            return 0
+        k = self.matrix.find(self.node, other)
+        return inf if k < 0 else self.matrix.weights[k]
+
+    def __setitem__(self, other: int, cost):
+        """
+        change the cost of the link to other, adding the link if needed
+        """
+        k = self.matrix.find(self.node, other)
+        if k >= 0:
+            self.matrix.weights[k] = cost
+        elif cost != inf:
+            self.matrix.insert(self.node, other, cost)
+
+    def __iter__(self):
+
+        return iter(self.dense())
+
+    def dense(self) -> list:
+        """
+        return the row as a list of num_nodes costs
+        """
+        row = [inf] * self.matrix.num_nodes
+        row[self.node] = 0
+        m = self.matrix
+        for k in range(m.indptr[self.node], m.indptr[self.node + 1]):
+            row[m.indices[k]] = m.weights[k]
+        return row
+
+    def neighbours(self) -> list:
+        """
+        return the ids of the nodes linked to this one with a finite cost, in
+        ascending order
+        """
+        m = self.matrix
+        start, end = m.indptr[self.node], m.indptr[self.node + 1]
+        return [m.indices[k] for k in range(start, end) if m.weights[k] != inf]
+
+
+def erdos_renyi(num_nodes: int, avg_degree: float, rng) -> SparseCost:
+    """
+    G(n, p) random graph with p = avg_degree / (num_nodes - 1), generated in
+    O(n + m) by skipping over absent links with geometric jumps (Batagelj and
+    Brandes, 2005); rng is a random.Random-like object
+    """
+    edges = []
+    p = avg_degree / (num_nodes - 1) if num_nodes > 1 else 0
+    if p >= 1:
+        edges = [(v, w, rng.choice(COST_CHOICES)) for v in range(num_nodes) for w in range(v)]
+    elif p > 0:
+        log_q = math.log(1.0 - p)
+        v, w = 1, -1
+        while v < num_nodes:
+            w += 1 + int(math.log(1.0 - rng.random()) / log_q)
+            while w >= v and v < num_nodes:
+                w -= v
+                v += 1
+            if v < num_nodes:
+                edges.append((v, w, rng.choice(COST_CHOICES)))
+    return SparseCost(num_nodes, edges)
+
+
+def waxman(num_nodes: int, avg_degree: float, rng) -> SparseCost:
+    """
+    Waxman graph: nodes are placed uniformly in the unit square and u - v is
+    linked with probability exp(-d(u, v) / s). s is picked so the expected
+    degree away from the border is avg_degree (n * 2 * pi * s^2 = avg_degree),
+    and pairs further apart than 7 * s (probability < 0.1%) are never drawn,
+    so only pairs in neighbouring cells of a grid of that size are tested
+    """
+    s = math.sqrt(avg_degree / (2 * math.pi * max(num_nodes - 1, 1)))
+    radius = 7 * s
+    cells_per_side = max(1, int(1 / radius))
+    xs = [rng.random() for _ in range(num_nodes)]
+    ys = [rng.random() for _ in range(num_nodes)]
+    cells = {}
+    for v in range(num_nodes):
+        key = (min(int(xs[v] * cells_per_side), cells_per_side - 1),
+               min(int(ys[v] * cells_per_side), cells_per_side - 1))
+        cells.setdefault(key, []).append(v)
+
+    edges = []
+    for (cx, cy), members in sorted(cells.items()):
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            others = cells.get((cx + dx, cy + dy))
+            if others is None:
+                continue
+            for i, u in enumerate(members):
+                # within a cell, test each pair once
+                for v in (members[i + 1:] if (dx, dy) == (0, 0) else others):
+                    d = math.hypot(xs[u] - xs[v], ys[u] - ys[v])
+                    if d <= radius and rng.random() < math.exp(-d / s):
+                        edges.append((u, v, rng.choice(COST_CHOICES)))
+    return SparseCost(num_nodes, edges)
+
+
+def grid(num_nodes: int, rng) -> SparseCost:
+    """
+    2D grid with rows of ceil(sqrt(num_nodes)) nodes; node i is linked to the
+    nodes to its right and below it, the last row may be partial
+    """
+    width = max(1, math.ceil(math.sqrt(num_nodes)))
+    edges = []
+    for v in range(num_nodes):
+        if (v + 1) % width != 0 and v + 1 < num_nodes:
+            edges.append((v, v + 1, rng.choice(COST_CHOICES)))
+        if v + width < num_nodes:
+            edges.append((v, v + width, rng.choice(COST_CHOICES)))
+    return SparseCost(num_nodes, edges)
+
+
+def fat_tree_size(k: int) -> int:
+    """
+    number of nodes of a k-ary fat tree: k^3/4 hosts, k^2/2 edge and k^2/2
+    aggregation switches and k^2/4 core switches
+    """
+    return k ** 3 // 4 + 5 * k * k // 4
+
+
+def fat_tree(num_nodes: int, rng) -> SparseCost:
+    """
+    k-ary fat tree (Al-Fares et al., 2008); num_nodes must be
+    fat_tree_size(k) for an even k. Node ids are the core switches, then
+    every pod's aggregation switches, edge switches and hosts
+    """
+    k = 2
+    while fat_tree_size(k) < num_nodes:
+        k += 2
+    if fat_tree_size(k) != num_nodes:
+        raise RuntimeError("A fat tree has {} or {} nodes, not {}".format(
+            fat_tree_size(k - 2), fat_tree_size(k), num_nodes))
+    half = k // 2
+    num_core = half * half
+    pod_size = k + half * half      # k/2 aggregation + k/2 edge switches + hosts
+    edges = []
+    for pod in range(k):
+        base = num_core + pod * pod_size
+        aggregation = range(base, base + half)
+        edge = range(base + half, base + k)
+        for a, agg in enumerate(aggregation):
+            for c in range(half):
+                edges.append((a * half + c, agg, rng.choice(COST_CHOICES)))
+            for e in edge:
+                edges.append((agg, e, rng.choice(COST_CHOICES)))
+        for i, e in enumerate(edge):
+            for h in range(half):
+                edges.append((e, base + k + i * half + h, rng.choice(COST_CHOICES)))
+    return SparseCost(num_nodes, edges)
+
+
+def load_edge_list(path: str, num_nodes: int) -> SparseCost:
+    """
+    read a graph from a text file with one "a b [cost]" link per line (cost
+    defaults to 1, "inf" is allowed); blank lines and lines starting with #
+    are ignored
+    """
+    edges = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            cost = 1
+            if len(fields) > 2:
+                cost = float(fields[2])
+                if cost.is_integer():
+                    cost = int(cost)
+            edges.append((int(fields[0]), int(fields[1]), cost))
+    return SparseCost(num_nodes, edges)